@@ -6,8 +6,10 @@ import cairo
 
 import numpy as np
 import cv2
+import os
 import threading
-import requests
+
+from src.Segmentation import BodypixClient
 
 
 class CamWindow(Gtk.Window):
@@ -19,6 +21,7 @@ class CamWindow(Gtk.Window):
         self.threadlock = threading.Lock()
         self.frame = None
         self.t = None
+        self.client = BodypixClient(socketpath=os.environ.get('BODYPIX_SOCKET'))
 
         self.set_position(Gtk.WindowPosition.CENTER)
         self.set_default_size(480, 270)
@@ -124,17 +127,9 @@ class CamWindow(Gtk.Window):
             self.queue_draw()
         cap.release()
 
-    def getMask(self, frame, bodypix_url='http://localhost:9000', scale=0.25):
-        sframe = cv2.resize(frame, (0, 0), fx=scale, fy=scale)
-        _, data = cv2.imencode(".jpg", sframe)
-        r = requests.post(
-            url=bodypix_url,
-            data=data.tobytes(),
-            headers={'Content-Type': 'application/octet-stream'})
-        mask = np.frombuffer(r.content, dtype=np.uint8)
-        mask = mask.reshape((sframe.shape[0], sframe.shape[1])) * 255
-        mask = cv2.resize(mask, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_LINEAR)
-        return mask
+    def getMask(self, frame, scale=0.25):
+        mask = self.client.segment(frame, scale)
+        return cv2.resize(mask, (frame.shape[1], frame.shape[0]))
 
     def startCam(self):
         self.dorun = True
@@ -145,6 +140,7 @@ class CamWindow(Gtk.Window):
         self.dorun = False
         if self.t is not None:
             self.t.join()
+        self.client.close()
         Gtk.main_quit()
         #return False
 
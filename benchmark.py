@@ -0,0 +1,244 @@
+#!python3
+import os
+import sys
+import time
+import itertools
+import socket
+import tempfile
+import threading
+import logging
+import socketserver
+import http.server
+import numpy as np
+import requests
+
+from src.Provider import *
+from src.Segmentation import BodypixClient, MockBackend, FRAMEFORMATS, MASKFORMATS, packMask
+
+
+def percentiles(samples):
+    samples = np.array(samples) * 1000
+    return "mean {:6.1f} ms, p50 {:6.1f} ms, p95 {:6.1f} ms".format(
+        samples.mean(), np.percentile(samples, 50), np.percentile(samples, 95))
+
+def camera(device=0, frames=200, work=0.05):
+    # glass-to-output latency: capture timestamp of the driver buffer until the
+    # frame has been processed by a consumer that needs `work` seconds per frame
+    for threaded in (False, True):
+        provider = CameraProvider(device=device, dimension=(1280, 720), threaded=threaded)
+        provider.reset()
+        ages = []
+        for i in range(frames):
+            ret, frame, mask = provider.next()
+            if ret == False:
+                break
+            time.sleep(work)
+            ages.append(time.monotonic() - provider.time)
+        provider.stop()
+        print("camera {} {:12}: {}".format(device, "threaded" if threaded else "synchronous", percentiles(ages[10:])))
+
+def timeit(f, repeat=50):
+    f()
+    t = time.perf_counter()
+    for i in range(repeat):
+        f()
+    return (time.perf_counter() - t) / repeat * 1000
+
+def desktop(dimension=(1280, 720)):
+    # processing cost of one grab for synthetic 1080p and 4K screens, plus the real grab if a display is available
+    provider = DesktopProvider(dimension=dimension, tilesize=0)
+    provider.area = {"left": 0, "top": 0}
+    tiled = DesktopProvider(dimension=dimension)
+    tiled.area = provider.area
+    r = 10
+    circ = np.zeros((r*2,r*2), np.uint8) + 255
+    circm = np.zeros((r*2,r*2), np.float64)
+    cv2.circle(circm, (r,r), r, (0.5), -1)
+    circ = circ * circm
+    circminv = 1 - circm
+    def copying(raw, shape):
+        # the previous implementation: copy, strided BGR view, float cursor, full resize
+        frame = np.array(np.frombuffer(raw, np.uint8).reshape(shape))[:,:,:3]
+        x, y = 100, 100
+        frame[y-r:y+r,x-r:x+r,2] = frame[y-r:y+r,x-r:x+r,2] * circminv[:,:] + circ[:,:]
+        for c in range(2):
+            frame[y-r:y+r,x-r:x+r,c] = frame[y-r:y+r,x-r:x+r,c] * circminv[:,:]
+        return cv2.resize(frame, dimension)
+    for name, (w, h) in (("1080p", (1920, 1080)), ("4K", (3840, 2160))):
+        raw = bytearray(np.random.randint(0, 255, (h, w, 4), np.uint8).tobytes())
+        before = timeit(lambda: copying(raw, (h, w, 4)))
+        after = timeit(lambda: provider.process(np.frombuffer(raw, np.uint8).reshape(h, w, 4)))
+        unchanged = timeit(lambda: tiled.process(np.frombuffer(raw, np.uint8).reshape(h, w, 4)))
+        # a screen that changes everywhere on every grab, e.g. a full screen video
+        raws = [raw, bytearray(np.random.randint(0, 255, (h, w, 4), np.uint8).tobytes())]
+        grabs = itertools.count()
+        changing = timeit(lambda: tiled.process(np.frombuffer(raws[next(grabs) % 2], np.uint8).reshape(h, w, 4)))
+        print("desktop {:5}: {:6.2f} ms per grab before, {:6.2f} ms after, with tile hashes {:6.2f} ms unchanged and {:6.2f} ms changing screen".format(
+            name, before, after, unchanged, changing))
+    try:
+        provider.reset()
+    except Exception as e:
+        print("desktop grab: no display ({})".format(e))
+        return
+    print("desktop grab {}x{}: {:6.2f} ms".format(provider.area["width"], provider.area["height"], timeit(provider.grab)))
+
+class StandinHandler(http.server.BaseHTTPRequestHandler):
+    # answers like the bodypix server without running a model
+    protocol_version = 'HTTP/1.1'
+    # node sends small responses immediately as well
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        size = self.headers.get('X-Frame-Size')
+        maskformat = self.headers.get('X-Mask-Format')
+        if size is None or maskformat not in MASKFORMATS:
+            mask = bytes(self.server.masksize)
+        else:
+            # a person in the middle of the frame
+            w, h = [int(v) for v in size.split('x')]
+            mask = np.zeros((h, w), np.uint8)
+            cv2.ellipse(mask, (w // 2, h * 3 // 4), (w // 5, h // 2), 0, 0, 360, 1, -1)
+            mask = packMask(mask, maskformat)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(mask)))
+        if maskformat in MASKFORMATS:
+            self.send_header('X-Mask-Format', maskformat)
+            self.send_header('X-Frame-Formats', ",".join(FRAMEFORMATS))
+        self.end_headers()
+        self.wfile.write(mask)
+
+    def log_message(self, *args):
+        pass
+
+class StandinUnixHandler(StandinHandler):
+    disable_nagle_algorithm = False
+
+class StandinUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # unix sockets have no client address, the request handler expects one
+        request, _ = super().get_request()
+        return (request, ('unix', 0))
+
+def segmentation(requests_=300, dimension=(1280, 720), scale=0.25):
+    # per-request overhead of the segmentation transport against a local stand-in server
+    sframe = np.random.randint(0, 255, (int(dimension[1] * scale), int(dimension[0] * scale), 3), np.uint8)
+    data = cv2.imencode(".jpg", sframe)[1].tobytes()
+    tcp = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandinHandler)
+    path = os.path.join(tempfile.mkdtemp(), 'bodypix.sock')
+    unix = StandinUnixServer(path, StandinUnixHandler)
+    for server in (tcp, unix):
+        server.masksize = sframe.shape[0] * sframe.shape[1]
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}'.format(tcp.server_address[1])
+    session = BodypixClient(url)
+    unixsocket = BodypixClient(socketpath=path)
+    variants = (
+        ("requests.post", lambda: requests.post(url=url, data=data, headers={'Content-Type': 'application/octet-stream'}).content),
+        ("pooled session", lambda: session.post(data)),
+        ("unix socket", lambda: unixsocket.post(data)),
+    )
+    for name, post in variants:
+        post()
+        samples = []
+        for i in range(requests_):
+            t = time.perf_counter()
+            post()
+            samples.append(time.perf_counter() - t)
+        print("segmentation {:15}: {}".format(name, percentiles(samples)))
+    session.close()
+    unixsocket.close()
+    for server in (tcp, unix):
+        server.shutdown()
+        server.server_close()
+    os.unlink(path)
+
+def wireformats(requests_=200, dimension=(1280, 720), scale=0.25):
+    # bytes on the wire and client cpu time per frame for every frame and mask format
+    frame = cv2.GaussianBlur(np.random.randint(0, 255, (dimension[1], dimension[0], 3), np.uint8), (15, 15), 0)
+    tcp = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandinHandler)
+    tcp.masksize = 0
+    threading.Thread(target=tcp.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}'.format(tcp.server_address[1])
+    for frameformat in FRAMEFORMATS:
+        for maskformat in MASKFORMATS:
+            client = BodypixClient(url, frameformat=frameformat, maskformat=maskformat)
+            # the first response announces the frame formats
+            client.segment(frame, scale)
+            client.sent, client.received = 0, 0
+            cpu = time.thread_time()
+            for i in range(requests_):
+                client.segment(frame, scale)
+            cpu = (time.thread_time() - cpu) / requests_
+            print("wire {:5} frames, {:5} masks: {:7.0f} bytes sent, {:7.0f} bytes received, {:5.2f} ms client cpu per frame".format(
+                frameformat, maskformat, client.sent / requests_, client.received / requests_, cpu * 1000))
+            client.close()
+    tcp.shutdown()
+    tcp.server_close()
+
+class StandinCamera(Provider):
+    # a camera at a fixed rate filming a still scene, with a square moving through it during the given frames
+
+    def __init__(self, fps=30, moving=(), **kwargs):
+        self.fps = fps
+        self.moving = moving
+        super().__init__(**kwargs)
+
+    def stop(self):
+        pass
+
+    def reset(self):
+        self.count = 0
+        self.deadline = time.monotonic()
+        self.background = cv2.GaussianBlur(np.random.randint(0, 255, (360, 640, 3), np.uint8), (9, 9), 0)
+
+    def next(self):
+        self.deadline += 1 / self.fps
+        time.sleep(max(0, self.deadline - time.monotonic()))
+        frame = self.background.copy()
+        x = 40 + 16 * sum(1 for i in range(self.count) if any(a <= i < b for a, b in self.moving))
+        cv2.rectangle(frame, (x % 560, 120), (x % 560 + 80, 240), (255, 255, 255), -1)
+        self.count += 1
+        return (True, frame, None)
+
+def pipelining(frames=90, latency=0.1):
+    # frame rate behind a backend that takes latency seconds per mask, every frame is segmented
+    for inflight in (0, 2):
+        provider = SegmentationProvider(StandinCamera(), MockBackend(latency=latency), dimension=(-1, -1),
+            inflight=inflight, motionthreshold=0, segmentevery=1)
+        provider.reset()
+        provider.next()
+        t = time.perf_counter()
+        for i in range(frames):
+            provider.next()
+        fps = frames / (time.perf_counter() - t)
+        provider.stop()
+        print("pipelining {} in flight, {:.0f} ms per mask: {:5.1f} fps".format(inflight, latency * 1000, fps))
+
+def gating(frames=200):
+    # masks requested for a still scene with two short movements, against segmenting every frame
+    moving = ((50, 70), (130, 150))
+    for name, params in (("every frame", dict(motionthreshold=0, segmentevery=1)), ("motion gated", {})):
+        provider = SegmentationProvider(StandinCamera(fps=1000, moving=moving), MockBackend(), dimension=(-1, -1),
+            inflight=0, **params)
+        provider.reset()
+        for i in range(frames):
+            provider.next()
+        provider.stop()
+        print("gating {:12}: {:3} of {} frames segmented, {} masks warped".format(name, provider.segmented, frames, provider.warped))
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='(%(threadName)-9s) %(message)s',)
+    benchmarks = {
+        'camera': camera,
+        'desktop': desktop,
+        'segmentation': segmentation,
+        'wireformats': wireformats,
+        'pipelining': pipelining,
+        'gating': gating,
+    }
+    for name in sys.argv[1:] or benchmarks.keys():
+        benchmarks[name]()
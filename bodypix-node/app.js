@@ -1,6 +1,67 @@
 const tf = require('@tensorflow/tfjs-node-gpu');
 const bodyPix = require('@tensorflow-models/body-pix');
 const http = require('http');
+const fs = require('fs');
+
+// frame formats the client may send, announced in every response
+const FRAME_FORMATS = ['jpeg', 'rgb', 'gray'];
+
+function frameSize(req) {
+    const size = req.headers['x-frame-size'];
+    return size ? size.split('x').map(Number) : null;
+}
+
+function decodeFrame(req, body) {
+    const format = req.headers['x-frame-format'] || 'jpeg';
+    const size = frameSize(req);
+    return tf.tidy(() => {
+        if (format === 'rgb' || format === 'gray') {
+            // raw pixels, row by row
+            const channels = format === 'rgb' ? 3 : 1;
+            const pixels = new Int32Array(new Uint8Array(body.buffer, body.byteOffset, body.length));
+            const image = tf.tensor3d(pixels, [size[1], size[0], channels], 'int32');
+            return channels === 3 ? image : tf.tile(image, [1, 1, 3]);
+        }
+        return tf.node.decodeImage(body, 3);
+    });
+}
+
+function encodeMask(data, format) {
+    if (format === 'bits') {
+        // eight pixels per byte, the first pixel in the highest bit
+        const out = Buffer.alloc(Math.ceil(data.length / 8));
+        for (let i = 0; i < data.length; i++) {
+            if (data[i]) {
+                out[i >> 3] |= 0x80 >> (i & 7);
+            }
+        }
+        return out;
+    }
+    if (format === 'rle') {
+        // alternating runs of background and foreground as uint16, longer runs are split by an empty run
+        const runs = [];
+        let value = 0;
+        let run = 0;
+        for (let i = 0; i < data.length; i++) {
+            const v = data[i] ? 1 : 0;
+            if (v !== value) {
+                runs.push(run);
+                value = v;
+                run = 0;
+            }
+            if (run === 0xFFFF) {
+                runs.push(run, 0);
+                run = 0;
+            }
+            run++;
+        }
+        runs.push(run);
+        const out = Buffer.alloc(runs.length * 2);
+        runs.forEach((r, i) => out.writeUInt16LE(r, i * 2));
+        return out;
+    }
+    return Buffer.from(data);
+}
 (async () => {
     const net = await bodyPix.load({
         architecture: 'MobileNetV1',
@@ -17,7 +78,7 @@ const http = require('http');
             chunks.push(chunk);
         });
         req.on('end', async () => {
-            const image = tf.node.decodeImage(Buffer.concat(chunks));
+            const image = decodeFrame(req, Buffer.concat(chunks));
             segmentation = await net.segmentPerson(image, {
                 flipHorizontal: false,
                 internalResolution: 'full',
@@ -26,11 +87,32 @@ const http = require('http');
                 segmentationThreshold: 0.7,
                 maxDetections: 2,
             });
-            res.writeHead(200, { 'Content-Type': 'application/octet-stream' });
-            res.write(Buffer.from(segmentation.data));
+            let maskFormat = req.headers['x-mask-format'];
+            if (maskFormat !== 'bits' && maskFormat !== 'rle') {
+                maskFormat = 'bytes';
+            }
+            res.writeHead(200, {
+                'Content-Type': 'application/octet-stream',
+                'X-Mask-Format': maskFormat,
+                'X-Frame-Formats': FRAME_FORMATS.join(','),
+            });
+            res.write(encodeMask(segmentation.data, maskFormat));
             res.end();
             tf.dispose(image);
         });
     });
+    // clients keep their connection open between frames
+    server.keepAliveTimeout = 60000;
     server.listen(9000);
+    // optionally also listen on a unix socket, e.g. BODYPIX_SOCKET=/tmp/bodypix.sock
+    const socketPath = process.env.BODYPIX_SOCKET;
+    if (socketPath) {
+        if (fs.existsSync(socketPath)) {
+            fs.unlinkSync(socketPath);
+        }
+        const unixServer = http.createServer();
+        unixServer.keepAliveTimeout = 60000;
+        unixServer.on('request', (req, res) => server.emit('request', req, res));
+        unixServer.listen(socketPath);
+    }
 })();
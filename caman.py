@@ -11,6 +11,7 @@ import cv2
 from src.Layer import *
 from src.Provider import *
 from src.pyfakewebcam import *
+from src.Trace import LatencyStats
 
 import importlib
 import config
@@ -24,6 +25,11 @@ class Caman():
         self.height = kwargs['dimension'][1]
         self.mousemode = ["", "", ""]
         self.mousepos = (0, 0)
+        self.traced = []
+        self.latency = {}
+        self.latencytime = time.monotonic()
+        self.render = None
+        self.renderkey = None
 
     def reloadConfig(self):
         try:
@@ -33,6 +39,8 @@ class Caman():
                 self.shutdownLayers()
                 self.background = cv2.resize(bg, (self.width, self.height))
                 self.layers = newlayers
+                self.latency = {}
+                self.render = None
                 self.updateLayerOrder()
                 self.startLayers()
         except Exception:
@@ -42,8 +50,14 @@ class Caman():
         self.layers.sort(key=lambda layer: layer.level)
 
     def renderLayers(self):
+        # skip compositing if no layer has a new frame and none was moved or resized
+        renderkey = [(id(layer), layer.version, layer.posx, layer.posy, layer.width, layer.height, layer.level) for layer in self.layers]
+        if self.render is not None and renderkey == self.renderkey:
+            return self.render
+        self.renderkey = renderkey
         # render all layers
         render = self.background.copy()
+        self.traced = []
         for layer in self.layers:
             # skip if layer is disabled or if frame is empty
             if layer.level < 0:
@@ -51,6 +65,9 @@ class Caman():
             frame = layer.getFrame()
             if frame is None:
                 continue
+            trace, layertime = layer.getTrace()
+            if trace is not None:
+                self.traced.append((layer, trace, layertime, time.monotonic()))
 
             # get bounding box of layer
             area = [layer.posy, layer.posx, layer.posy + layer.height, layer.posx + layer.width]
@@ -77,14 +94,42 @@ class Caman():
                 if mask is None:
                     render[area[0]:area[2], area[1]:area[3], :] = frame[crop[0]:crop[2],crop[1]:crop[3],:]
                 else:
-                    for c in range(frame.shape[2]):
-                        render[area[0]:area[2], area[1]:area[3],c] \
-                            = frame[crop[0]:crop[2],crop[1]:crop[3],c] * mask[0][crop[0]:crop[2],crop[1]:crop[3]] \
-                            + render[area[0]:area[2], area[1]:area[3],c] * mask[1][crop[0]:crop[2],crop[1]:crop[3]]
+                    # masks stay at the resolution they were made at until here, scale them up once
+                    if mask.shape[:2] != frame.shape[:2]:
+                        mask = cv2.resize(mask, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_LINEAR)
+                    self.blend(render[area[0]:area[2], area[1]:area[3]], frame[crop[0]:crop[2],crop[1]:crop[3]], mask[crop[0]:crop[2],crop[1]:crop[3]])
             except:
                 print(traceback.format_exc())
+        self.render = render
         return render
 
+    def blend(self, dst, src, mask):
+        # dst = src * mask + dst * (255 - mask), in 8 bit with at most one level of rounding error
+        mask = cv2.merge([mask] * src.shape[2])
+        fg = cv2.multiply(src, mask, scale=1/255)
+        bg = cv2.multiply(dst, cv2.bitwise_not(mask), scale=1/255)
+        cv2.add(fg, bg, dst=dst)
+
+    def recordLatency(self, writetime):
+        # frames of camera-backed layers carry their capture time up to the v4l2 write
+        for layer, trace, layertime, compositetime in self.traced:
+            if layer not in self.latency:
+                self.latency[layer] = LatencyStats()
+            self.latency[layer].add(trace, layertime, compositetime, writetime)
+        if writetime - self.latencytime > 10:
+            self.latencytime = writetime
+            for layer, stats in self.latency.items():
+                logging.info("latency of layer {} ({}): {}".format(layer.level, type(layer.provider).__name__, stats.format()))
+            for layer in self.layers:
+                if isinstance(layer, AnimatedLayer) and layer.level >= 0:
+                    logging.info("rate of layer {} ({}): {}".format(layer.level, type(layer.provider).__name__, self.formatRate(layer)))
+
+    def formatRate(self, layer):
+        achieved, requested, skipped = layer.getRate()
+        if requested is None:
+            return "{:.1f} fps".format(achieved)
+        return "{:.1f} of {:.1f} fps, {} skipped".format(achieved, requested, skipped)
+
     def handleInput(self):
         # receive keyboard input
         key = cv2.waitKey(1)
@@ -216,6 +261,8 @@ class Caman():
                 cv2.line(render, (hoveredlayer.posx,hoveredlayer.posy+hoveredlayer.height//3),   (hoveredlayer.posx+hoveredlayer.width,hoveredlayer.posy+hoveredlayer.height//3),   (255, 0, 0, 1))
                 cv2.line(render, (hoveredlayer.posx,hoveredlayer.posy+hoveredlayer.height*2//3), (hoveredlayer.posx+hoveredlayer.width,hoveredlayer.posy+hoveredlayer.height*2//3), (255, 0, 0, 1))
                 cv2.rectangle(render, (hoveredlayer.posx,hoveredlayer.posy), (hoveredlayer.posx+hoveredlayer.width,hoveredlayer.posy+hoveredlayer.height),(0,255,0), 1)
+                if isinstance(hoveredlayer, AnimatedLayer):
+                    cv2.putText(render, self.formatRate(hoveredlayer), (hoveredlayer.posx+5, hoveredlayer.posy+20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0))
         return render
 
     def run(self, **kwargs):
@@ -246,17 +293,18 @@ class Caman():
         loop = True
         fps = 0.0
         while loop:
-            t = time.time()
+            t = time.monotonic()
             render = self.renderLayers()
             # pass to fake
             #render = cv2.cvtColor(render, cv2.COLOR_BGR2RGB)
             self.fake.schedule_frame(render)
-            # show info image
-            render = self.renderAdditionalInfo(render, fps)
+            self.recordLatency(time.monotonic())
+            # show info image, the render may be reused for the next frame
+            render = self.renderAdditionalInfo(render.copy(), fps)
             cv2.imshow("Caman", render)
             loop = self.handleInput()
             # print current fps
-            fps = 1 / (time.time() - t);
+            fps = 1 / (time.monotonic() - t);
             #logging.info(fps)
 
         self.shutdownLayers()
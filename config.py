@@ -3,6 +3,7 @@ import sys
 
 from src.Layer import *
 from src.Provider import *
+from src.Segmentation import *
 
 def meeting(width, height):
     bg = np.zeros((height, width, 3), np.uint8) + 34
@@ -17,6 +18,8 @@ def virtualbackground(width, height):
     bg = cv2.imread("res/background.jpg")
     layers = [
         AnimatedLayer(position=(0,0),   dimension=(width,height), level=6, frame=None, mask=None, provider=HologramFilter(ord('h'), SmoothingFilter(ord('s'), InvertFilter(ord('i'), Boomerang(2.0, ord(' '), BodypixProvider(CameraProvider(device=0))))))),
+        # without the bodypix server, e.g. in front of a green screen
+        #AnimatedLayer(position=(0,0),   dimension=(width,height), level=6, frame=None, mask=None, provider=Boomerang(2.0, ord(' '), SegmentationProvider(CameraProvider(device=0), ChromaKeyBackend()))),
     ]
     return (bg, layers)
 
@@ -30,7 +33,7 @@ def webcam(width, height):
 def screenshare(width, height):
     bg = np.zeros((height, width, 3), np.uint8) + 128
     layers = [
-        AnimatedLayer(position=(0,0),                   dimension=(width,height),       level=2, frame=None, mask=None, provider=Frequency(20, DesktopProvider())),
+        AnimatedLayer(position=(0,0),                   dimension=(width,height),       level=2, frame=None, mask=None, provider=Frequency(30, DesktopProvider(capturefps=5))),
         #AnimatedLayer(position=(width*6//10,height//2), dimension=(width//2,height//2), level=6, frame=None, mask=None, provider=Boomerang(2.0, ord(' '), BodypixProvider(CameraProvider(device=0)))),
         AnimatedLayer(position=(width*75//100,height*7//10), dimension=(width*3//10,height*3//10), level=6, frame=None, mask=None, provider=HologramFilter(ord('h'), SmoothingFilter(ord('s'), InvertFilter(ord('i'), Boomerang(2.0, ord(' '), BodypixProvider(CameraProvider(device=0))))))),
     ]
@@ -0,0 +1,334 @@
+import os
+import time
+import struct
+import shutil
+import hashlib
+import tempfile
+import threading
+import collections
+import logging
+import numpy as np
+import cv2
+
+
+class AssetCache(object):
+
+    def __init__(self, directory, maxsize=1 << 30):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(directory, exist_ok=True)
+        except OSError as e:
+            logging.warning("asset cache disabled: {}".format(e))
+            self.directory = None
+
+    def key(self, path, **params):
+        # decoded assets are only valid for the same file content and decode parameters
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        description = repr((os.path.abspath(path), stat.st_mtime_ns, stat.st_size, sorted(params.items())))
+        return hashlib.sha1(description.encode("utf-8")).hexdigest()
+
+    def load(self, key):
+        # memory-map all arrays of an entry, None if it is not cached
+        if self.directory is None or key is None:
+            return None
+        entry = os.path.join(self.directory, key)
+        try:
+            arrays = {}
+            for name in os.listdir(entry):
+                if name.endswith('.npy'):
+                    arrays[name[:-4]] = np.load(os.path.join(entry, name), mmap_mode='r')
+            # the modification time of an entry is its last use
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+        logging.debug("asset cache hit {}".format(key))
+        return arrays
+
+    def store(self, key, arrays):
+        if self.directory is None or key is None:
+            return
+        tmp = self.begin()
+        if tmp is None:
+            return
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp, name + '.npy'), np.ascontiguousarray(array))
+        except OSError as e:
+            logging.warning("could not cache {}: {}".format(key, e))
+            self.abort(tmp)
+            return
+        self.commit(key, tmp)
+
+    def begin(self):
+        # entries are written into a temporary directory and renamed by commit(), readers never see partial entries
+        if self.directory is None:
+            return None
+        try:
+            return tempfile.mkdtemp(dir=self.directory, prefix='.tmp')
+        except OSError as e:
+            logging.warning("could not create cache entry: {}".format(e))
+            return None
+
+    def commit(self, key, tmp):
+        try:
+            os.rename(tmp, os.path.join(self.directory, key))
+        except OSError as e:
+            self.abort(tmp)
+            if not os.path.isdir(os.path.join(self.directory, key)):
+                logging.warning("could not cache {}: {}".format(key, e))
+            return
+        self.evict()
+
+    def abort(self, tmp):
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    def evict(self):
+        # remove the least recently used entries until the cache fits into maxsize
+        self.lock.acquire()
+        try:
+            entries = []
+            for key in os.listdir(self.directory):
+                entry = os.path.join(self.directory, key)
+                if not os.path.isdir(entry):
+                    continue
+                if key.startswith('.'):
+                    # left behind by a crash while it was written
+                    if os.path.getmtime(entry) < time.time() - 24 * 3600:
+                        shutil.rmtree(entry, ignore_errors=True)
+                    continue
+                size = sum([os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry)])
+                entries.append((os.path.getmtime(entry), size, entry))
+            entries.sort()
+            total = sum([size for _, size, _ in entries])
+            while total > self.maxsize and len(entries) > 0:
+                _, size, entry = entries.pop(0)
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+                logging.debug("asset cache evicted {}".format(entry))
+        except OSError as e:
+            logging.warning("asset cache eviction failed: {}".format(e))
+        finally:
+            self.lock.release()
+
+
+cache = AssetCache(os.environ.get('CAMAN_CACHE', os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'caman')))
+
+
+class ArrayWriter(object):
+
+    HEADERSIZE = 128
+
+    def __init__(self, path):
+        # appends arrays of the same shape to a .npy file, the header is written once the count is known
+        self.file = open(path, 'wb')
+        self.file.write(bytes(ArrayWriter.HEADERSIZE))
+        self.shape = None
+        self.dtype = None
+        self.count = 0
+
+    def append(self, array):
+        if self.shape is None:
+            self.shape, self.dtype = array.shape, array.dtype
+        elif array.shape != self.shape or array.dtype != self.dtype:
+            raise ValueError("expected {} {}, got {} {}".format(self.shape, self.dtype, array.shape, array.dtype))
+        self.file.write(np.ascontiguousarray(array).data)
+        self.count += 1
+
+    def close(self):
+        # version 1.0 header padded to HEADERSIZE, see numpy.lib.format
+        header = "{{'descr': {!r}, 'fortran_order': False, 'shape': {!r}, }}".format(
+            np.lib.format.dtype_to_descr(self.dtype), (self.count,) + self.shape)
+        header = header.ljust(ArrayWriter.HEADERSIZE - 11) + '\n'
+        self.file.seek(0)
+        self.file.write(np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + header.encode('latin1'))
+        self.file.close()
+
+    def discard(self):
+        self.file.close()
+
+
+class FrameSequence(object):
+
+    def __init__(self, key, maxbytes=None):
+        # plays a clip from the cache or records its decoded frames during the first pass.
+        # recorded frames go straight into the cache entry, the clip is never held in memory
+        self.key = key
+        self.maxbytes = cache.maxsize // 4 if maxbytes is None else maxbytes
+        self.index = 0
+        self.frames = None
+        self.durations = None
+        self.recording = None
+        entry = cache.load(key)
+        if entry is not None and 'frames' in entry and 'durations' in entry:
+            self.frames, self.durations = entry['frames'], entry['durations']
+        elif key is not None:
+            self.recording = cache.begin()
+            if self.recording is not None:
+                self.writer = ArrayWriter(os.path.join(self.recording, 'frames.npy'))
+                self.recorded = []
+                self.nbytes = 0
+
+    def cached(self):
+        return self.frames is not None
+
+    def next(self):
+        if self.index >= len(self.frames):
+            return None
+        self.index += 1
+        return (self.frames[self.index-1], float(self.durations[self.index-1]))
+
+    def record(self, frame, duration):
+        if self.recording is None:
+            return
+        # give up on clips that change size while playing or are too large
+        self.nbytes += frame.nbytes
+        if self.nbytes > self.maxbytes or (self.writer.shape is not None and self.writer.shape != frame.shape):
+            self.abort()
+            return
+        try:
+            self.writer.append(frame)
+        except OSError as e:
+            logging.warning("could not cache {}: {}".format(self.key, e))
+            self.abort()
+            return
+        self.recorded.append(duration)
+
+    def finish(self):
+        if self.recording is None:
+            return
+        if len(self.recorded) == 0:
+            self.abort()
+            return
+        try:
+            self.writer.close()
+            np.save(os.path.join(self.recording, 'durations.npy'), np.array(self.recorded))
+        except OSError as e:
+            logging.warning("could not cache {}: {}".format(self.key, e))
+            self.abort()
+            return
+        tmp, self.recording = self.recording, None
+        threading.Thread(target=cache.commit, args=(self.key, tmp), name="assetcache", daemon=True).start()
+
+    def abort(self):
+        # drop a recording that will not be finished
+        if self.recording is None:
+            return
+        self.writer.discard()
+        cache.abort(self.recording)
+        self.recording = None
+
+
+class ImageAsset(object):
+
+    def __init__(self, path, cachesize=8, maxoverhead=0.5, minsize=16):
+        self.path = path
+        self.cachesize = cachesize
+        self.maxoverhead = maxoverhead
+        self.minsize = minsize
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # the decoded pyramid is memory-mapped from the asset cache after the first start
+        key = cache.key(path, kind='image', maxoverhead=maxoverhead, minsize=minsize)
+        entry = cache.load(key)
+        if entry is not None and 'frame0' in entry:
+            self.loadPyramid(entry)
+        else:
+            self.load()
+            self.buildPyramid()
+            cache.store(key, self.storePyramid())
+
+    def load(self):
+        image = cv2.imread(self.path, cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise FileNotFoundError('could not read image: {}'.format(self.path))
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        self.frame, self.mask = image, None
+        if image.shape[2] == 4:
+            self.frame, self.mask = image[:, :, :3], image[:, :, 3]
+        logging.debug("load {} ({}x{})".format(self.path, self.frame.shape[1], self.frame.shape[0]))
+
+    def buildPyramid(self):
+        # halve the image until it is small or the extra memory exceeds maxoverhead of the source.
+        # a full pyramid needs about a third of the source
+        self.levels = [(self.frame, self.mask)]
+        size = self.frame.nbytes + (self.mask.nbytes if self.mask is not None else 0)
+        self.overhead = 0
+        while min(self.levels[-1][0].shape[:2]) >= 2 * self.minsize:
+            frame, mask = self.levels[-1]
+            frame = cv2.pyrDown(frame)
+            if mask is not None:
+                mask = cv2.pyrDown(mask)
+            nbytes = frame.nbytes + (mask.nbytes if mask is not None else 0)
+            if self.overhead + nbytes > self.maxoverhead * size:
+                break
+            self.overhead += nbytes
+            self.levels.append((frame, mask))
+        logging.debug("pyramid of {}: {} levels, {} kB overhead ({:.0f}%)".format(
+            self.path, len(self.levels), self.overhead // 1024, 100 * self.overhead / size))
+
+    def storePyramid(self):
+        arrays = {}
+        for i, (frame, mask) in enumerate(self.levels):
+            arrays['frame{}'.format(i)] = frame
+            if mask is not None:
+                arrays['mask{}'.format(i)] = mask
+        return arrays
+
+    def loadPyramid(self, arrays):
+        self.levels = []
+        while 'frame{}'.format(len(self.levels)) in arrays:
+            i = len(self.levels)
+            self.levels.append((arrays['frame{}'.format(i)], arrays.get('mask{}'.format(i))))
+        self.frame, self.mask = self.levels[0]
+        self.overhead = sum([frame.nbytes + (mask.nbytes if mask is not None else 0) for frame, mask in self.levels[1:]])
+
+    def dimension(self, width, height):
+        # fill in a missing side from the aspect ratio, (-1, -1) keeps the original size
+        if width <= 0 and height <= 0:
+            return (self.frame.shape[1], self.frame.shape[0])
+        elif width > 0 and height > 0:
+            return (width, height)
+        elif width > 0:
+            return (width, width * self.frame.shape[0] // self.frame.shape[1])
+        return (height * self.frame.shape[1] // self.frame.shape[0], height)
+
+    def resize(self, dimension):
+        # start from the smallest level that is still at least as large as the target
+        frame, mask = self.levels[0]
+        for level in self.levels[1:]:
+            if level[0].shape[1] < dimension[0] or level[0].shape[0] < dimension[1]:
+                break
+            frame, mask = level
+        if dimension == (frame.shape[1], frame.shape[0]):
+            return (frame, mask)
+        # the level is less than twice the target, bilinear does not alias anymore
+        frame = cv2.resize(frame, dimension, interpolation=cv2.INTER_LINEAR)
+        if mask is not None:
+            mask = cv2.resize(mask, dimension, interpolation=cv2.INTER_LINEAR)
+        return (frame, mask)
+
+    def get(self, width, height):
+        # resized frame and mask, the last few sizes are kept for interactive resizing
+        dimension = self.dimension(width, height)
+        self.lock.acquire()
+        try:
+            if dimension in self.cache:
+                self.cache.move_to_end(dimension)
+                return self.cache[dimension]
+        finally:
+            self.lock.release()
+        resized = self.resize(dimension)
+        self.lock.acquire()
+        try:
+            self.cache[dimension] = resized
+            while len(self.cache) > self.cachesize:
+                self.cache.popitem(last=False)
+        finally:
+            self.lock.release()
+        return resized
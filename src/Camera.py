@@ -0,0 +1,231 @@
+import threading
+import time
+import logging
+import collections
+import cv2
+
+
+def fourccCode(fourcc):
+    return cv2.VideoWriter_fourcc(*fourcc)
+
+def fourccName(code):
+    code = int(code)
+    return "".join([chr((code >> 8 * i) & 0xFF) for i in range(4)])
+
+
+class CameraGrabber(object):
+
+    def __init__(self, device, resolution=None, fps=30, fourcc=None):
+        self.device = device
+        self.resolution = resolution
+        self.fps = fps
+        self.fourcc = fourcc
+        self.cap = None
+        self.t = None
+        self.dorun = False
+        self.paused = False
+        self.ret = True
+        self.frame = None
+        self.time = 0
+        self.seq = 0
+        self.resumeseq = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.cond = threading.Condition()
+
+    def negotiate(self):
+        # pick the pixel format first, the available resolutions depend on it.
+        # MJPEG is needed for anything above VGA on most USB2 cameras, YUYV avoids decoding otherwise
+        fourcc = self.fourcc
+        if fourcc is None and self.resolution is not None:
+            fourcc = 'MJPG' if self.resolution[0] * self.resolution[1] > 640 * 480 else 'YUYV'
+        if fourcc is not None:
+            self.cap.set(cv2.CAP_PROP_FOURCC, fourccCode(fourcc))
+        if self.resolution is not None:
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[0])
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[1])
+        if self.fps is not None and self.fps > 0:
+            self.cap.set(cv2.CAP_PROP_FPS, self.fps)
+        # only keep a single buffer queued in the driver
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        logging.info("camera {} negotiated {}x{} @ {} fps, format {} (requested {} @ {} fps, format {})".format(
+            self.device,
+            int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            self.cap.get(cv2.CAP_PROP_FPS), fourccName(self.cap.get(cv2.CAP_PROP_FOURCC)),
+            self.resolution, self.fps, fourcc))
+
+    def open(self):
+        self.cap = cv2.VideoCapture(self.device)
+        self.negotiate()
+        self.ret = True
+        self.dorun = True
+        self.t = threading.Thread(target=self.run, name="camera{}".format(self.device), daemon=True)
+        self.t.start()
+
+    def close(self):
+        self.cond.acquire()
+        try:
+            self.dorun = False
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+        if self.t is not None and self.t is not threading.current_thread():
+            self.t.join()
+        self.t = None
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+
+    def pause(self):
+        self.cond.acquire()
+        try:
+            self.paused = True
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def resume(self):
+        self.cond.acquire()
+        try:
+            self.paused = False
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def sleep(self):
+        # release the device while nobody needs frames, it is opened and negotiated again on resume
+        self.cap.release()
+        logging.info("camera {} paused".format(self.device))
+        self.cond.acquire()
+        try:
+            # the last frame is from before the pause, subscribers only get frames of the reopened device
+            self.frame = None
+            self.resumeseq = self.seq
+            self.cond.wait_for(lambda: self.paused == False or self.dorun == False)
+        finally:
+            self.cond.release()
+        if self.dorun == True:
+            self.cap = cv2.VideoCapture(self.device)
+            self.negotiate()
+
+    def captureTime(self, now):
+        # v4l2 stamps buffers with CLOCK_MONOTONIC when the frame was captured.
+        # fall back to the time the read returned if the backend reports something else
+        stamp = self.cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+        if 0 < now - stamp < 1.0:
+            return stamp
+        return now
+
+    def run(self):
+        while self.dorun == True:
+            if self.paused == True:
+                self.sleep()
+                continue
+            ret, frame = self.cap.read()
+            t = self.captureTime(time.monotonic())
+            self.cond.acquire()
+            try:
+                if ret == True:
+                    # frames are shared between all subscribers, nobody may write into them
+                    frame.flags.writeable = False
+                    if self.frame is not None and self.delivered < self.seq:
+                        self.dropped += 1
+                    self.frame = frame
+                    self.time = t
+                    self.seq += 1
+                else:
+                    self.ret = False
+                    self.dorun = False
+                self.cond.notify_all()
+            finally:
+                self.cond.release()
+
+    def latest(self, seq, timeout=1.0):
+        # wait for a frame newer than seq, stale frames have already been overwritten
+        self.cond.acquire()
+        try:
+            seq = max(seq, self.resumeseq)
+            self.cond.wait_for(lambda: self.seq > seq or self.dorun == False, timeout)
+            if self.seq <= seq:
+                # nothing new in time, e.g. the device is still being opened again after a pause
+                return (self.ret, seq, None, self.time)
+            self.delivered = self.seq
+            return (self.ret, self.seq, self.frame, self.time)
+        finally:
+            self.cond.release()
+
+
+class CameraBroker(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.grabbers = {}
+        self.subscribers = collections.defaultdict(int)
+        self.suspended = collections.defaultdict(int)
+
+    def subscribe(self, device, resolution=None, fps=30, fourcc=None):
+        # every device is opened once, later subscribers share the running grabber
+        self.lock.acquire()
+        try:
+            grabber = self.grabbers.get(device)
+            if grabber is None:
+                grabber = CameraGrabber(device, resolution, fps, fourcc)
+                grabber.open()
+                self.grabbers[device] = grabber
+            elif resolution is not None and grabber.resolution is not None \
+                and (resolution[0] > grabber.resolution[0] or resolution[1] > grabber.resolution[1]):
+                logging.info("camera {} already opened with {}, {} will be upscaled".format(device, grabber.resolution, resolution))
+            self.subscribers[device] += 1
+            self.update(device)
+            logging.debug("camera {} has {} subscribers".format(device, self.subscribers[device]))
+            return grabber
+        finally:
+            self.lock.release()
+
+    def update(self, device):
+        # the grabber only runs while at least one subscriber is not suspended
+        grabber = self.grabbers.get(device)
+        if grabber is None:
+            return
+        if self.suspended[device] >= self.subscribers[device]:
+            grabber.pause()
+        else:
+            grabber.resume()
+
+    def suspend(self, device):
+        self.lock.acquire()
+        try:
+            self.suspended[device] += 1
+            self.update(device)
+        finally:
+            self.lock.release()
+
+    def resume(self, device):
+        self.lock.acquire()
+        try:
+            self.suspended[device] -= 1
+            self.update(device)
+        finally:
+            self.lock.release()
+
+    def unsubscribe(self, device, suspended=False):
+        # close the device when the last subscriber is gone
+        self.lock.acquire()
+        try:
+            self.subscribers[device] -= 1
+            if suspended:
+                self.suspended[device] -= 1
+            if self.subscribers[device] > 0:
+                self.update(device)
+                return
+            del self.subscribers[device]
+            self.suspended.pop(device, None)
+            grabber = self.grabbers.pop(device, None)
+        finally:
+            self.lock.release()
+        if grabber is not None:
+            grabber.close()
+            logging.debug("camera {} closed".format(device))
+
+
+broker = CameraBroker()
@@ -0,0 +1,86 @@
+import threading
+import collections
+
+
+class EventQueue(object):
+
+    def __init__(self):
+        # commands for the providers of a layer, handed from the ui thread to the layer thread
+        self.cond = threading.Condition()
+        self.events = collections.deque()
+        self.closed = False
+        self.wakeups = 0
+        self.listeners = []
+
+    def put(self, event):
+        self.cond.acquire()
+        try:
+            self.events.append(event)
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def drain(self):
+        self.cond.acquire()
+        try:
+            events = list(self.events)
+            self.events.clear()
+            return events
+        finally:
+            self.cond.release()
+
+    def wait(self, timeout=None):
+        # block until an event is queued, wake() is called or the queue is closed, True if there are events
+        self.cond.acquire()
+        try:
+            wakeups = self.wakeups
+            self.cond.wait_for(lambda: len(self.events) > 0 or self.closed or self.wakeups != wakeups, timeout)
+            return len(self.events) > 0
+        finally:
+            self.cond.release()
+
+    def wake(self):
+        # return from wait() without an event, e.g. to let the layer thread be paused
+        self.cond.acquire()
+        try:
+            self.wakeups += 1
+            self.cond.notify_all()
+            listeners = list(self.listeners)
+        finally:
+            self.cond.release()
+        self.notifyListeners(listeners)
+
+    def listen(self, cond):
+        # cond is notified on wake() and close() as well, for providers that block on something else
+        self.cond.acquire()
+        try:
+            if cond not in self.listeners:
+                self.listeners.append(cond)
+        finally:
+            self.cond.release()
+
+    def notifyListeners(self, listeners):
+        for cond in listeners:
+            cond.acquire()
+            try:
+                cond.notify_all()
+            finally:
+                cond.release()
+
+    def open(self):
+        self.cond.acquire()
+        try:
+            self.closed = False
+        finally:
+            self.cond.release()
+
+    def close(self):
+        # wake up everyone waiting, the layer is stopping
+        self.cond.acquire()
+        try:
+            self.closed = True
+            self.cond.notify_all()
+            listeners = list(self.listeners)
+        finally:
+            self.cond.release()
+        self.notifyListeners(listeners)
@@ -0,0 +1,168 @@
+import logging
+import tempfile
+import numpy as np
+import cv2
+
+
+class FrameRing(object):
+
+    def __init__(self, capacity, maxbytes=None):
+        self.requested = max(2, capacity)
+        self.maxbytes = maxbytes
+        self.capacity = self.requested
+        self.frames = None
+        self.masks = None
+        self.times = np.zeros(self.capacity)
+        self.traces = [None] * self.capacity
+        self.start = 0
+        self.count = 0
+
+    def fit(self, frame, mask):
+        # fewer frames than requested if that many would take more than maxbytes
+        capacity = self.requested
+        if self.maxbytes is not None:
+            size = frame.nbytes + (0 if mask is None else mask.nbytes)
+            capacity = max(2, min(capacity, self.maxbytes // size))
+            if capacity < self.requested:
+                logging.info("history: keeping {} of {} frames of {}x{} below {} MB".format(
+                    capacity, self.requested, frame.shape[1], frame.shape[0], self.maxbytes >> 20))
+        self.capacity = capacity
+        self.times = np.zeros(self.capacity)
+        self.traces = [None] * self.capacity
+        self.start = 0
+        self.count = 0
+
+    def allocate(self, frame, mask):
+        # one block for the whole history, reallocated only if the frame size changes
+        self.fit(frame, mask)
+        self.frames = np.empty((self.capacity,) + frame.shape, frame.dtype)
+        self.masks = None if mask is None else np.empty((self.capacity,) + mask.shape, mask.dtype)
+
+    def append(self, frame, mask, t, trace=None):
+        if self.frames is None or self.frames.shape[1:] != frame.shape \
+            or (mask is None) != (self.masks is None) or (mask is not None and self.masks.shape[1:] != mask.shape):
+            self.allocate(frame, mask)
+        # overwrite the oldest slot once the ring is full
+        idx = (self.start + self.count) % self.capacity
+        if self.count == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.count += 1
+        np.copyto(self.frames[idx], frame)
+        if mask is not None:
+            np.copyto(self.masks[idx], mask)
+        self.times[idx] = t
+        self.traces[idx] = trace
+
+    def trim(self, t):
+        # drop frames older than t
+        while self.count > 0 and self.times[self.start] < t:
+            self.start = (self.start + 1) % self.capacity
+            self.count -= 1
+
+    def __len__(self):
+        return self.count
+
+    def get(self, idx):
+        return {
+            'frame': self.frames[idx],
+            'mask': None if self.masks is None else self.masks[idx],
+            'time': self.times[idx],
+            'trace': self.traces[idx],
+        }
+
+    def snapshot(self):
+        return Snapshot(self, (self.start + np.arange(self.count)) % self.capacity)
+
+
+class DiskRing(FrameRing):
+
+    def __init__(self, capacity, maxbytes=None, directory=None):
+        # frames live in memory-mapped temporary files, only the pages in use take RAM
+        self.directory = directory
+        super().__init__(capacity, maxbytes)
+
+    def allocate(self, frame, mask):
+        self.fit(frame, mask)
+        self.frames = np.memmap(tempfile.TemporaryFile(dir=self.directory), frame.dtype, 'w+', shape=(self.capacity,) + frame.shape)
+        self.masks = None
+        if mask is not None:
+            self.masks = np.memmap(tempfile.TemporaryFile(dir=self.directory), mask.dtype, 'w+', shape=(self.capacity,) + mask.shape)
+
+
+class CompressedRing(FrameRing):
+
+    def __init__(self, capacity, maxbytes=256 << 20, quality=85):
+        # frames are kept as jpeg and masks as png, decoded only when played back
+        super().__init__(capacity, maxbytes)
+        self.quality = quality
+        self.frames = [None] * self.capacity
+        self.masks = [None] * self.capacity
+        self.nbytes = 0
+        self.truncated = False
+
+    def size(self, idx):
+        return (len(self.frames[idx]) if self.frames[idx] is not None else 0) \
+            + (len(self.masks[idx]) if self.masks[idx] is not None else 0)
+
+    def append(self, frame, mask, t, trace=None):
+        idx = (self.start + self.count) % self.capacity
+        if self.count == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.count += 1
+        self.nbytes -= self.size(idx)
+        self.frames[idx] = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])[1].tobytes()
+        self.masks[idx] = None if mask is None else cv2.imencode(".png", mask)[1].tobytes()
+        self.nbytes += self.size(idx)
+        self.times[idx] = t
+        self.traces[idx] = trace
+        # stay below maxbytes no matter how long the duration is
+        while self.nbytes > self.maxbytes and self.count > 1:
+            self.drop()
+            if not self.truncated:
+                self.truncated = True
+                logging.info("history: keeping {} of {} frames below {} MB".format(self.count, self.capacity, self.maxbytes >> 20))
+
+    def drop(self):
+        self.nbytes -= self.size(self.start)
+        self.frames[self.start] = None
+        self.masks[self.start] = None
+        self.traces[self.start] = None
+        self.start = (self.start + 1) % self.capacity
+        self.count -= 1
+
+    def trim(self, t):
+        while self.count > 0 and self.times[self.start] < t:
+            self.drop()
+
+    def get(self, idx):
+        return {
+            'frame': cv2.imdecode(np.frombuffer(self.frames[idx], np.uint8), cv2.IMREAD_COLOR),
+            'mask': None if self.masks[idx] is None else cv2.imdecode(np.frombuffer(self.masks[idx], np.uint8), cv2.IMREAD_GRAYSCALE),
+            'time': self.times[idx],
+            'trace': self.traces[idx],
+        }
+
+
+class Snapshot(object):
+
+    def __init__(self, ring, indices):
+        # views into the ring, valid as long as nothing is appended to it
+        self.ring = ring
+        self.indices = indices
+        self.last = (None, None)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def time(self, i):
+        # without decoding the frame
+        return self.ring.times[self.indices[i]]
+
+    def __getitem__(self, i):
+        # the frame being played back is looked up several times, decode it once
+        idx = self.indices[i]
+        if self.last[0] != idx:
+            self.last = (idx, self.ring.get(idx))
+        return self.last[1]
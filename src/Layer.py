@@ -4,13 +4,22 @@ import logging
 import numpy as np
 import cv2
 
+from .Asset import ImageAsset
+from .Timebase import RateMeter
+from .Events import EventQueue
+
 class Layer(object):
 
     def __init__(self, **kwargs):
         self.frame = None
-        self.mask = None
+        self.trace = None
+        self.tracetime = 0
+        self.rawmask = None
+        self.version = 0
+        self.published = 0
         self.framelock = threading.Lock()
         self.masklock = threading.Lock()
+        self.publishcond = threading.Condition()
         self.setParams(kwargs)
 
     def setParams(self, kwargs):
@@ -31,31 +40,67 @@ class Layer(object):
         return False
 
     def updateDimension(self):
-        frame = self.getFrame()
-        mask = self.getMask()
+        frame, mask = self.frame, self.rawmask
         if frame is not None:
             frame = cv2.resize(frame, (self.width, self.height))
         if mask is not None:
-            mask = cv2.resize(mask[0], (self.width, self.height)) * 255
+            mask = cv2.resize(mask, (self.width, self.height))
         self.writeFrame(frame)
         self.writeMask(mask)
+        self.publish()
+
+    def publish(self):
+        # wake up everyone waiting for a new frame of this layer
+        self.publishcond.acquire()
+        try:
+            self.published += 1
+            self.publishcond.notify_all()
+        finally:
+            self.publishcond.release()
 
-    def writeFrame(self, frame):
+    def waitFrame(self, seen, timeout=1.0, cancel=None):
+        # wait until a frame newer than seen is published or cancel() returns True and return it
+        # without copying. published frames are never written to, subscribers get read-only views
+        self.publishcond.acquire()
+        try:
+            self.publishcond.wait_for(lambda: self.published > seen or (cancel is not None and cancel()), timeout)
+            published = self.published
+        finally:
+            self.publishcond.release()
+        self.framelock.acquire()
+        try:
+            frame, trace = self.frame, self.trace
+        finally:
+            self.framelock.release()
+        self.masklock.acquire()
+        try:
+            mask = self.rawmask
+        finally:
+            self.masklock.release()
+        if frame is not None:
+            frame = frame.view()
+            frame.flags.writeable = False
+        if mask is not None:
+            mask = mask.view()
+            mask.flags.writeable = False
+        return (published, frame, mask, trace)
+
+    def writeFrame(self, frame, trace=None):
         self.framelock.acquire()
         try:
             self.frame = frame
+            self.trace = trace
+            self.tracetime = time.monotonic()
+            self.version += 1
         finally:
             self.framelock.release()
 
     def writeMask(self, mask):
         self.masklock.acquire()
         try:
-            if mask is None:
-                self.mask = None
-                self.invmask = None
-            else:
-                self.mask = mask / 255
-                self.invmask = 1 - self.mask
+            # masks may be smaller than the frame, they cover all of it and are scaled when composited
+            self.rawmask = mask
+            self.version += 1
         finally:
             self.masklock.release()
 
@@ -69,50 +114,51 @@ class Layer(object):
             self.framelock.release()
         return res
 
+    def getTrace(self):
+        # trace of the current frame and the time it was written into the layer
+        self.framelock.acquire()
+        try:
+            return (self.trace, self.tracetime)
+        finally:
+            self.framelock.release()
+
     def getMask(self):
-        res = None
+        # masks are replaced and never written to, a read-only view is enough
         self.masklock.acquire()
         try:
-            if self.mask is not None:
-                res = (self.mask.copy(), self.invmask.copy())
+            mask = self.rawmask
         finally:
             self.masklock.release()
-        return res
+        if mask is not None:
+            mask = mask.view()
+            mask.flags.writeable = False
+        return mask
 
 
 class ImageLayer(Layer):
 
     def __init__(self, **kwargs):
+        self.asset = None
         super().__init__(**kwargs)
         if 'path' in kwargs:
             self.loadImage(kwargs['path'])
 
     def updateDimension(self):
-        super().updateDimension()
+        # resize from the decoded image instead of the current frame
         self.reload()
 
     def loadImage(self, path):
         self.path = path
+        self.asset = ImageAsset(path)
         self.reload()
 
     def reload(self):
-        image = cv2.imread(self.path, cv2.IMREAD_UNCHANGED)
-        if self.width <= 0 and self.height <= 0:
-            self.height = image.shape[0]
-            self.width = image.shape[1]
-        else:
-            if self.width > 0 and self.height > 0:
-                pass
-            elif self.width > 0:
-                self.height = self.width * image.shape[0] // image.shape[1]
-            elif self.height > 0:
-                self.width = self.height * image.shape[1] // image.shape[0]
-            image = cv2.resize(image, (self.width, self.height))
-        if image.shape[2] == 4:
-            alpha = image[:, :, 3]
-            image = image[:, :, :3]
+        self.width, self.height = self.asset.dimension(self.width, self.height)
+        image, alpha = self.asset.get(self.width, self.height)
+        if alpha is not None:
             self.writeMask(alpha)
         self.writeFrame(image)
+        self.publish()
 
 
 class AnimatedLayer(Layer):
@@ -122,11 +168,14 @@ class AnimatedLayer(Layer):
         self.threadlock = threading.Lock()
         self.pauselock = threading.Lock()
         self.dorun = False
+        self.rate = RateMeter()
+        self.events = EventQueue()
         if 'provider' in kwargs:
             self.setProvider(kwargs['provider'])
 
     def setProvider(self, provider):
         self.provider = provider
+        self.provider.setParams({'events': self.events})
         self.reset()
 
     def updateDimension(self):
@@ -134,24 +183,43 @@ class AnimatedLayer(Layer):
         self.provider.setParams({'dimension': (self.width, self.height)})
 
     def command(self, **kwargs):
-        return self.provider.command(**kwargs)
+        # providers are only touched by the layer thread, commands are queued for it
+        if self.provider.accepts(**kwargs):
+            self.events.put(kwargs)
+            return True
+        return False
+
+    def handleEvents(self):
+        for event in self.events.drain():
+            self.provider.command(**event)
 
     def reset(self):
         self.updateDimension()
         self.provider.reset()
 
+    def getRate(self):
+        # achieved frame rate of the layer thread, the requested one and the frames skipped to keep it
+        pacer = self.provider.getPacer()
+        if pacer is None:
+            return (self.rate.rate(), None, 0)
+        return (self.rate.rate(), pacer.requested, pacer.skipped)
+
     def stop(self):
         self.dorun = False
+        self.events.close()
         self.provider.stop()
+        self.publish()
 
     def start(self):
         if self.dorun == False:
             self.dorun = True
+            self.events.open()
             self.t = threading.Thread(target=self.run)
             self.t.start()
 
     def pause(self):
         self.pauselock.acquire()
+        self.events.wake()
         self.threadlock.acquire()
         self.pauselock.release()
 
@@ -162,18 +230,28 @@ class AnimatedLayer(Layer):
         while self.dorun == True:
             self.threadlock.acquire()
             try:
+                self.handleEvents()
                 ret, frame, mask = self.provider.next()
                 if ret == False:
                     self.level = -self.level
                     self.stop()
                 else:
+                    self.rate.tick()
                     if frame is not None:
                         if self.height < 0:
                             self.height = frame.shape[0]
                         if self.width < 0:
                             self.width = frame.shape[1]
-                    self.writeFrame(frame)
-                    self.writeMask(mask)
+                    # providers hand out the same objects when nothing changed
+                    changed = False
+                    if frame is not self.frame:
+                        self.writeFrame(frame, self.provider.getTrace())
+                        changed = True
+                    if mask is not self.rawmask:
+                        self.writeMask(mask)
+                        changed = True
+                    if changed:
+                        self.publish()
             finally:
                 self.threadlock.release()
             self.pauselock.acquire()
@@ -1,17 +1,26 @@
 import abc
+import os
+import signal
 from enum import Enum
 import threading
 import time
+import math
 import logging
-import collections
 import numpy as np
 import cv2
-import requests
 import subprocess
 import mss
 from PIL import Image
 import mouseinfo
 
+from .Camera import CameraGrabber, broker
+from .Trace import FrameTrace
+from .Text import getAtlas, colorize
+from .Asset import ImageAsset, FrameSequence, cache
+from .History import FrameRing, CompressedRing, DiskRing
+from .Timebase import Pacer, now
+from .Segmentation import BodypixBackend, CircuitBreaker
+
 class Provider(object):
 
     __metaclass__ = abc.ABCMeta
@@ -20,11 +29,17 @@ class Provider(object):
         self.provider = None
         self.frame = None
         self.mask = None
+        self.trace = None
+        self.pacer = None
+        self.events = None
         self.setParams(kwargs)
 
     def setParams(self, kwargs):
         if 'provider' in kwargs:
             self.provider = kwargs.pop('provider', None)
+        # queue of the layer commands arrive on, providers may block on it while idle
+        if 'events' in kwargs:
+            self.events = kwargs['events']
         if 'dimension' in kwargs:
             self.width = kwargs['dimension'][0]
             self.height = kwargs['dimension'][1]
@@ -34,6 +49,33 @@ class Provider(object):
             return self.provider.command(**kwargs)
         return False
 
+    def accepts(self, **kwargs):
+        # whether command() would handle kwargs, must not change any state
+        if self.provider is not None:
+            return self.provider.accepts(**kwargs)
+        return False
+
+    def getTrace(self):
+        # trace of the last returned frame, decorators pass on the one of their source
+        if self.trace is None and self.provider is not None:
+            return self.provider.getTrace()
+        return self.trace
+
+    def suspend(self):
+        # the output is not needed until resume, sources may stop capturing in between
+        if self.provider is not None:
+            self.provider.suspend()
+
+    def resume(self):
+        if self.provider is not None:
+            self.provider.resume()
+
+    def getPacer(self):
+        # pacer that sets the rate of the returned frames, decorators without one pass on the upstream one
+        if self.pacer is None and self.provider is not None:
+            return self.provider.getPacer()
+        return self.pacer
+
     @abc.abstractmethod
     def stop(self):
         pass
@@ -52,6 +94,7 @@ class ImageProvider(Provider):
     def __init__(self, path, **kwargs):
         self.frame = None
         self.mask = None
+        self.asset = None
         kwargs['path'] = path
         super().__init__(**kwargs)
 
@@ -65,25 +108,16 @@ class ImageProvider(Provider):
 
     def reset(self):
         self.stop()
-        self.frame = cv2.imread(self.path, cv2.IMREAD_UNCHANGED)
-        if self.frame.shape[2] == 4:
-            self.mask = self.frame[:, :, 3]
-            self.frame = self.frame[:, :, :3]
+        # keep the decoded image, it does not change between resets
+        if self.asset is None or self.asset.path != self.path:
+            self.asset = ImageAsset(self.path)
+        self.frame, self.mask = self.asset.frame, self.asset.mask
 
     def next(self):
-        frame, mask = self.frame, self.mask
-        if self.width <= 0 and self.height <= 0:
-            pass
-        else:
-            if self.width > 0 and self.height > 0:
-                pass
-            elif self.width > 0:
-                self.height = self.width * frame.shape[0] // frame.shape[1]
-            elif self.height > 0:
-                self.width = self.height * frame.shape[1] // frame.shape[0]
-            frame = cv2.resize(frame, (self.width, self.height))
-            if mask is not None:
-                mask = cv2.resize(mask, (self.width, self.height))
+        if self.width > 0 or self.height > 0:
+            self.width, self.height = self.asset.dimension(self.width, self.height)
+        # the resized image is memoized per size
+        frame, mask = self.asset.get(self.width, self.height)
         return (True, frame, mask)
 
 
@@ -92,7 +126,8 @@ class GIFProvider(Provider):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.cap = None
-        self.time = 0
+        self.sequence = None
+        self.pacer = Pacer()
         if 'path' in kwargs:
             self.path = kwargs['path']
 
@@ -101,7 +136,8 @@ class GIFProvider(Provider):
         self.reset()
 
     def stop(self):
-        pass
+        if self.sequence is not None:
+            self.sequence.abort()
 
     def reset(self):
         self.stop()
@@ -116,33 +152,51 @@ class GIFProvider(Provider):
                 self.height = self.width * self.cap.size[1] // self.cap.size[0]
             elif self.height > 0:
                 self.width = self.height * self.cap.size[0] // self.cap.size[1]
+        # decoded frames at this size are kept in the asset cache
+        self.sequence = FrameSequence(cache.key(self.path, kind='gif', dimension=(self.width, self.height)))
+
+    def decode(self):
+        self.cap.seek(self.cap.tell()+1)
+        #frame = self.cap.convert('RGB')
+        frame = np.array(self.cap.convert('RGBA'), dtype=np.uint8)
+        frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2BGRA)
+        return (frame, self.cap.info['duration'] / 1000)
+
+    def read(self):
+        if self.sequence.cached():
+            item = self.sequence.next()
+            if item is None:
+                return (False, None, None, 0)
+            frame, duration = item
+        else:
+            frame, duration = self.decode()
+        if self.width <= 0 and self.height <= 0:
+            pass
+        else:
+            if self.width > 0 and self.height > 0:
+                pass
+            elif self.width > 0:
+                self.height = self.width * frame.shape[0] // frame.shape[1]
+            elif self.height > 0:
+                self.width = self.height * frame.shape[1] // frame.shape[0]
+            if frame.shape[1] != self.width or frame.shape[0] != self.height:
+                frame = cv2.resize(frame, (self.width, self.height))
+        if not self.sequence.cached():
+            self.sequence.record(frame, duration)
+        return (True, frame[:, :, :3], frame[:, :, 3], duration)
 
     def next(self):
         try:
-            self.cap.seek(self.cap.tell()+1)
-            #frame = self.cap.convert('RGB')
-            frame = np.array(self.cap.convert('RGBA'), dtype=np.uint8)
-            frame = cv2.cvtColor(frame, cv2.COLOR_RGBA2BGRA)
-            if self.width <= 0 and self.height <= 0:
-                pass
-            else:
-                if self.width > 0 and self.height > 0:
-                    pass
-                elif self.width > 0:
-                    self.height = self.width * frame.shape[0] // frame.shape[1]
-                elif self.height > 0:
-                    self.width = self.height * frame.shape[1] // frame.shape[0]
-                frame = cv2.resize(frame, (self.width, self.height))
-            mask = frame[:, :, 3]
-            frame = frame[:, :, :3]
-            # delay returning frame
-            duration = self.cap.info['duration'] / 1000
-            sleep = self.time + duration - time.time()
-            if sleep > 0:
-                time.sleep(sleep)
-            self.time = time.time()
-            return (True, frame, mask)
+            ret, frame, mask, duration = self.read()
+            if ret == False:
+                return (False, None, None)
+            # frames whose deadline passed are dropped, the animation stays in time
+            for i in range(self.pacer.wait(duration)):
+                if ret == True:
+                    ret, frame, mask, _ = self.read()
+            return (ret, frame, mask)
         except EOFError:
+            self.sequence.finish()
             return (False, None, None)
 
 
@@ -150,18 +204,38 @@ class LayerProvider(Provider):
 
     def __init__(self, layer, **kwargs):
         self.layer = layer
+        self.version = 0
+        self.resized = (None, None)
+        self.cancel = threading.Event()
         super().__init__(**kwargs)
 
     def stop(self):
-        pass
+        self.cancel.set()
+        self.layer.publishcond.acquire()
+        try:
+            self.layer.publishcond.notify_all()
+        finally:
+            self.layer.publishcond.release()
+
+    def setParams(self, kwargs):
+        super().setParams(kwargs)
+        # pausing the layer of this provider wakes its events, they have to end the wait for the source too
+        if self.events is not None:
+            self.events.listen(self.layer.publishcond)
 
     def reset(self):
-        pass
+        self.cancel.clear()
 
     def next(self):
-        frame = self.layer.getFrame()
-        mask = self.layer.getMask()
+        # sleep until the source layer publishes a new frame, or the own layer is paused or stopped
+        wakeups = 0 if self.events is None else self.events.wakeups
+        version, frame, mask, trace = self.layer.waitFrame(self.version,
+            cancel=lambda: self.cancel.is_set() or (self.events is not None and (self.events.wakeups != wakeups or self.events.closed)))
         ret = self.layer.dorun
+        if version == self.version:
+            return (ret, self.resized[0], self.resized[1])
+        self.version = version
+        self.trace = trace
         if frame is not None:
             if self.width <= 0 and self.height <= 0:
                 pass
@@ -172,9 +246,11 @@ class LayerProvider(Provider):
                     self.height = self.width * frame.shape[0] // frame.shape[1]
                 elif self.height > 0:
                     self.width = self.height * frame.shape[1] // frame.shape[0]
-                frame = cv2.resize(frame, (self.width, self.height))
-            if mask is not None:
-                mask = cv2.resize(mask[0], (frame.shape[1], frame.shape[0])) * 255
+                # share the buffer of the source if the size already matches
+                if frame.shape[1] != self.width or frame.shape[0] != self.height:
+                    frame = cv2.resize(frame, (self.width, self.height))
+        # the mask covers the frame whatever its size, the compositor scales it
+        self.resized = (frame, mask)
         return (ret, frame, mask)
 
 
@@ -183,7 +259,8 @@ class VideoProvider(Provider):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.cap = None
-        self.time = 0
+        self.sequence = None
+        self.pacer = Pacer()
         if 'path' in kwargs:
             self.path = kwargs['path']
 
@@ -194,6 +271,8 @@ class VideoProvider(Provider):
     def stop(self):
         if self.cap is not None:
             self.cap.release()
+        if self.sequence is not None:
+            self.sequence.abort()
 
     def reset(self):
         self.stop()
@@ -219,10 +298,25 @@ class VideoProvider(Provider):
             elif self.height > 0:
                 self.width = int(self.height * self.cap.get(cv2.CAP_PROP_FRAME_WIDTH) // self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
         logging.debug("reload {}, fps: {}".format(self.path, self.cap.get(cv2.CAP_PROP_FPS)))
+        # decoded frames at this size are kept in the asset cache
+        self.sequence = FrameSequence(cache.key(self.path, kind='video', dimension=(self.width, self.height)))
+        if self.sequence.cached():
+            self.cap.release()
 
-    def next(self):
-        mask = None
+    def decode(self):
+        if self.sequence.cached():
+            item = self.sequence.next()
+            if item is None:
+                return (False, None)
+            return (True, item[0])
         ret, frame = self.cap.read()
+        if ret == False:
+            self.sequence.finish()
+        return (ret, frame)
+
+    def read(self):
+        mask = None
+        ret, frame = self.decode()
         if ret == True:
             if self.width <= 0 and self.height <= 0:
                 pass
@@ -233,16 +327,22 @@ class VideoProvider(Provider):
                     self.height = self.width * frame.shape[0] // frame.shape[1]
                 elif self.height > 0:
                     self.width = self.height * frame.shape[1] // frame.shape[0]
-                frame = cv2.resize(frame, (self.width, self.height))
+                if frame.shape[1] != self.width or frame.shape[0] != self.height:
+                    frame = cv2.resize(frame, (self.width, self.height))
+            if not self.sequence.cached():
+                self.sequence.record(frame, self.frametime)
             if frame.shape[2] == 4:
                 mask = frame[:, :, 3]
                 frame = frame[:, :, :3]
+        return (ret, frame, mask)
 
-            # delay returning frame
-            sleep = self.time + self.frametime - time.time()
-            if sleep > 0:
-                time.sleep(sleep)
-            self.time = time.time()
+    def next(self):
+        ret, frame, mask = self.read()
+        if ret == True:
+            # frames whose deadline passed are dropped, the video stays in time
+            for i in range(self.pacer.wait(self.frametime)):
+                if ret == True:
+                    ret, frame, mask = self.read()
         return (ret, frame, mask)
 
 
@@ -250,15 +350,40 @@ class CameraProvider(Provider):
 
     def __init__(self, **kwargs):
         self.cap = None
+        self.grabber = None
+        self.seq = 0
         self.time = 0
+        self.latency = 0
+        self.frames = 0
+        self.suspended = False
+        kwargs.setdefault('fps', 30)
+        kwargs.setdefault('fourcc', None)
+        kwargs.setdefault('resolution', None)
+        kwargs.setdefault('sizehint', None)
+        kwargs.setdefault('threaded', True)
         super().__init__(**kwargs)
 
     def setParams(self, kwargs):
         super().setParams(kwargs)
         if 'device' in kwargs:
             self.device = kwargs['device']
+        if 'fps' in kwargs:
+            self.fps = kwargs['fps']
+        if 'fourcc' in kwargs:
+            self.fourcc = kwargs['fourcc']
+        if 'resolution' in kwargs:
+            self.resolution = kwargs['resolution']
+        # size a decorator resizes the frames to, set by those that need them at full size
+        if 'sizehint' in kwargs:
+            self.sizehint = kwargs['sizehint']
+        if 'threaded' in kwargs:
+            self.threaded = kwargs['threaded']
 
     def stop(self):
+        if self.grabber is not None:
+            if self.threaded == True:
+                broker.unsubscribe(self.device, self.suspended)
+            self.grabber = None
         if self.cap is not None:
             self.cap.release()
             self.cap = None
@@ -267,16 +392,64 @@ class CameraProvider(Provider):
         self.stop()
         logging.debug("reload camera {}".format(self.device))
 
-    def next(self):
-        if self.cap is None:
+    def requestedResolution(self):
+        # ask the device for what the layer needs instead of resizing every frame
+        if self.resolution is not None:
+            return self.resolution
+        if self.width > 0 and self.height > 0:
+            return (self.width, self.height)
+        if self.sizehint is not None and self.sizehint[0] > 0 and self.sizehint[1] > 0:
+            return tuple(self.sizehint)
+        return None
+
+    def open(self):
+        if self.threaded == True:
+            self.seq = 0
+            self.grabber = broker.subscribe(self.device, self.requestedResolution(), self.fps, self.fourcc)
+            if self.suspended:
+                broker.suspend(self.device)
+        else:
+            self.grabber = CameraGrabber(self.device, self.requestedResolution(), self.fps, self.fourcc)
             self.cap = cv2.VideoCapture(self.device)
-            #self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
-            #self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
-            #self.cap.set(cv2.CAP_PROP_FPS, self.fps)
+            self.grabber.cap = self.cap
+            self.grabber.negotiate()
+
+    def suspend(self):
+        # the shared grabber pauses once all its subscribers are suspended,
+        # a synchronous capture is closed and opened again by the next call of next()
+        if self.suspended:
+            return
+        self.suspended = True
+        if self.grabber is not None:
+            if self.threaded == True:
+                broker.suspend(self.device)
+            else:
+                self.stop()
+
+    def resume(self):
+        if not self.suspended:
+            return
+        self.suspended = False
+        if self.grabber is not None and self.threaded == True:
+            broker.resume(self.device)
+
+    def grab(self):
+        if self.threaded == True:
+            ret, self.seq, frame, t = self.grabber.latest(self.seq)
+        else:
+            ret, frame = self.cap.read()
+            t = self.grabber.captureTime(time.monotonic())
+        return (ret, frame, t)
+
+    def next(self):
+        if self.grabber is None:
+            self.open()
         # get frame
         mask = None
-        ret, frame = self.cap.read()
-        if ret == True:
+        ret, frame, t = self.grab()
+        if ret == True and frame is not None:
+            self.time = t
+            self.trace = FrameTrace(t)
             if self.width <= 0 and self.height <= 0:
                 pass
             else:
@@ -286,9 +459,14 @@ class CameraProvider(Provider):
                     self.height = self.width * frame.shape[0] // frame.shape[1]
                 elif self.height > 0:
                     self.width = self.height * frame.shape[1] // frame.shape[0]
-                frame = cv2.resize(frame, (self.width, self.height))
-                if mask is not None:
-                    mask = cv2.resize(mask, (self.width, self.height))
+                if frame.shape[1] != self.width or frame.shape[0] != self.height:
+                    frame = cv2.resize(frame, (self.width, self.height))
+            # time from capture until the frame leaves the provider
+            self.latency = 0.9 * self.latency + 0.1 * (time.monotonic() - t)
+            self.frames += 1
+            if self.frames % 300 == 0:
+                logging.debug("camera {}: latency {:.1f} ms, {} stale frames dropped".format(
+                    self.device, self.latency * 1000, self.grabber.dropped))
         return (ret, frame, mask)
 
 
@@ -296,50 +474,318 @@ class DesktopProvider(Provider):
 
     def __init__(self, **kwargs):
         self.sct = None
-        self.monitor = None
-        kwargs.setdefault('monitor', {"top": 0, "left": 0, "width": 1920, "height": 1080})
+        self.area = None
+        self.sprite = None
+        self.hashes = None
+        self.weights = None
+        self.base = None
+        self.output = None
+        self.cursor = None
+        self.changed = []
+        self.tiles = 0
+        self.skippedtiles = 0
+        self.backoff = 0
+        self.skiphashes = 0
+        self.grabs = 0
+        self.dirty = False
+        self.scalefactor = 1.0
+        self.t = None
+        self.dorun = False
+        self.lock = threading.Lock()
+        self.captured = threading.Event()
+        self.suspended = False
+        self.active = threading.Event()
+        kwargs.setdefault('monitor', 1)
+        kwargs.setdefault('region', None)
+        kwargs.setdefault('cursorradius', 10)
+        kwargs.setdefault('tilesize', 64)
+        kwargs.setdefault('hashstride', None)
+        kwargs.setdefault('capturefps', 0)
         super().__init__(**kwargs)
 
     def setParams(self, kwargs):
         super().setParams(kwargs)
         if 'monitor' in kwargs:
             self.monitor = kwargs['monitor']
+        if 'region' in kwargs:
+            self.region = kwargs['region']
+        if 'cursorradius' in kwargs:
+            self.cursorradius = kwargs['cursorradius']
+        # tiles of tilesize pixels are compared with the previous grab, 0 disables it.
+        # hashstride only hashes every n-th row which is cheaper but may miss thin changes,
+        # None hashes about as many rows as a 1080p screen has
+        if 'tilesize' in kwargs:
+            self.tilesize = kwargs['tilesize']
+        if 'hashstride' in kwargs:
+            self.hashstride = None if kwargs['hashstride'] is None else max(1, kwargs['hashstride'])
+        # capture the screen on a separate thread at capturefps while the cursor is drawn
+        # at the rate next() is called, 0 captures on every call of next()
+        if 'capturefps' in kwargs:
+            self.capturefps = kwargs['capturefps']
+        if 'dimension' in kwargs:
+            self.lock.acquire()
+            try:
+                self.sprite = None
+                self.base = None
+            finally:
+                self.lock.release()
 
     def stop(self):
+        self.dorun = False
+        self.active.set()
+        if self.t is not None:
+            self.t.join()
+            self.t = None
         self.sct = None
 
     def reset(self):
         self.stop()
         self.sct = mss.mss()
-        r = 10
-        self.r = r
-        self.circ = np.zeros((r*2,r*2), np.uint8) + 255
-        circm = np.zeros((r*2,r*2), np.float)
-        cv2.circle(circm, (r,r), r, (0.5), -1)
-        self.circ = self.circ * circm
-        self.circminv = 1 - circm
-
-    def next(self):
-        # get screen frame
-        frame = np.array(self.sct.grab(self.monitor))[:,:,:3] # is the 4th channel of any use...?
-        # draw current mouse position
-        x,y = mouseinfo.position()
-        x = max(self.r, min(frame.shape[1]-self.r, x))
-        y = max(self.r, min(frame.shape[0]-self.r, y))
-        frame[y-self.r:y+self.r,x-self.r:x+self.r,2] = frame[y-self.r:y+self.r,x-self.r:x+self.r,2] * self.circminv[:,:] + self.circ[:,:]
-        for c in range(2):
-            frame[y-self.r:y+self.r,x-self.r:x+self.r,c] = frame[y-self.r:y+self.r,x-self.r:x+self.r,c] * self.circminv[:,:]
-        # resize if necessary
+        self.selectArea()
+        self.sprite = None
+        self.hashes = None
+        self.backoff = 0
+        self.skiphashes = 0
+        self.base = None
+        self.output = None
+        self.captured.clear()
+        if self.capturefps > 0:
+            # mss handles can not be shared between threads
+            self.sct = None
+
+    def start(self):
+        # the capture thread is started by the first call of next(), not while the layer is built
+        self.dorun = True
+        if not self.suspended:
+            self.active.set()
+        else:
+            self.active.clear()
+        self.t = threading.Thread(target=self.run, name="desktop", daemon=True)
+        self.t.start()
+
+    def selectArea(self):
+        # monitor is either an index into the mss monitor list or an area dict
+        monitor = self.monitor
+        if not isinstance(monitor, dict):
+            monitor = self.sct.monitors[monitor]
+        # region (x, y, width, height) limits the capture to a part of the monitor
+        if self.region is not None:
+            x, y, w, h = self.region
+            monitor = {"left": monitor["left"] + x, "top": monitor["top"] + y, "width": w, "height": h}
+        self.area = {"left": monitor["left"], "top": monitor["top"], "width": monitor["width"], "height": monitor["height"]}
+
+    def createSprite(self, scale):
+        # half transparent red dot, blended with integer math
+        r = max(1, int(round(self.cursorradius * scale)))
+        alpha = np.zeros((r*2, r*2), np.uint8)
+        cv2.circle(alpha, (r, r), r, 128, -1)
+        alpha = alpha.astype(np.uint16)[:, :, None]
+        color = np.zeros((r*2, r*2, 3), np.uint16)
+        color[:, :, 2] = 255
+        self.sprite = (r, scale, color * alpha, 256 - alpha)
+
+    def cursorPosition(self, frame, scale):
+        r = self.sprite[0]
+        x, y = mouseinfo.position()
+        x = int((x - self.area["left"]) * scale)
+        y = int((y - self.area["top"]) * scale)
+        x = max(r, min(frame.shape[1]-r, x))
+        y = max(r, min(frame.shape[0]-r, y))
+        return (x, y)
+
+    def drawCursor(self, frame, scale, position=None):
+        if self.sprite is None or self.sprite[1] != scale:
+            self.createSprite(scale)
+        r, _, premultiplied, invalpha = self.sprite
+        if frame.shape[0] < 2*r or frame.shape[1] < 2*r:
+            return
+        x, y = self.cursorPosition(frame, scale) if position is None else position
+        roi = frame[y-r:y+r, x-r:x+r]
+        roi[:] = (roi * invalpha + premultiplied) >> 8
+
+    def hashTiles(self, bgra):
+        # positional hash of every tile: sum of row weight * column weight * pixel, wrapping in uint64
+        ts = self.tilesize
+        h, w = bgra.shape[:2]
+        stride = self.hashstride
+        if stride is None:
+            stride = max(1, int(round(w * h / (1920 * 1080))))
+        stride = min(stride, ts)
+        if self.weights is None or self.weights[0].shape[0] != w or self.weights[1].shape[0] != (h + stride - 1) // stride:
+            rng = np.random.default_rng(0)
+            self.weights = (rng.integers(1, 2**63, w, dtype=np.uint64) | np.uint64(1),
+                rng.integers(1, 2**63, ((h + stride - 1) // stride, 1), dtype=np.uint64) | np.uint64(1))
+        pixels = np.ascontiguousarray(bgra).view(np.uint32)[::stride, :, 0]
+        columns = np.add.reduceat(np.multiply(pixels, self.weights[0]), np.arange(0, w, ts), axis=1)
+        rows = np.arange(0, h, ts)
+        return np.add.reduceat(columns * self.weights[1], (rows + stride - 1) // stride, axis=0)
+
+    def changedTiles(self, bgra):
+        # list of changed tiles as (x, y, width, height) in screen pixels, None without a previous grab to compare with
+        ts = self.tilesize
+        h, w = bgra.shape[:2]
+        hashes = self.hashTiles(bgra)
+        previous, self.hashes = self.hashes, hashes
+        if previous is None or previous.shape != hashes.shape:
+            return None
+        changed = hashes != previous
+        self.tiles += changed.size
+        self.skippedtiles += changed.size - np.count_nonzero(changed)
+        tiles = []
+        for ty, tx in zip(*np.nonzero(changed)):
+            x, y = int(tx) * ts, int(ty) * ts
+            tiles.append((x, y, min(ts, w - x), min(ts, h - y)))
+        return tiles
+
+    def scale(self, bgra):
         if self.width <= 0 and self.height <= 0:
             pass
         else:
             if self.width > 0 and self.height > 0:
                 pass
             elif self.width > 0:
-                self.height = self.width * frame.shape[0] // frame.shape[1]
+                self.height = self.width * bgra.shape[0] // bgra.shape[1]
             elif self.height > 0:
-                self.width = self.height * frame.shape[1] // frame.shape[0]
-            frame = cv2.resize(frame, (self.width, self.height))
+                self.width = self.height * bgra.shape[1] // bgra.shape[0]
+        if self.width <= 0 or (self.width == bgra.shape[1] and self.height == bgra.shape[0]):
+            return None
+        return (self.width, self.height)
+
+    def resize(self, bgra, dimension):
+        if dimension is None:
+            return cv2.cvtColor(bgra, cv2.COLOR_BGRA2BGR)
+        # downscale in one step, then drop alpha on the small image
+        return cv2.cvtColor(cv2.resize(bgra, dimension, interpolation=cv2.INTER_AREA), cv2.COLOR_BGRA2BGR)
+
+    def updateBase(self, bgra, dimension):
+        # only resize the changed tiles into the downscaled screen
+        h, w = bgra.shape[:2]
+        target = (w, h) if dimension is None else dimension
+        if self.skiphashes > 0:
+            # the screen kept changing everywhere, hashing would only add to the full resize
+            self.skiphashes -= 1
+            self.hashes = None
+            self.changed = [(0, 0, w, h)]
+            self.base = self.resize(bgra, dimension)
+            return True
+        tiles = self.changedTiles(bgra)
+        self.changed = [(0, 0, w, h)] if tiles is None else tiles
+        if tiles is None or self.base is None or self.base.shape[1] != target[0] or self.base.shape[0] != target[1]:
+            self.base = self.resize(bgra, dimension)
+            return True
+        if len(tiles) * self.tilesize * self.tilesize > w * h // 2:
+            # leave out the hashes of the next grabs, twice as many each time the screen changed again
+            self.backoff = min(32, max(1, 2 * self.backoff))
+            self.skiphashes = self.backoff
+            self.base = self.resize(bgra, dimension)
+            return True
+        self.backoff = 0
+        if len(tiles) == 0:
+            return False
+        # align the regions to the smallest block that maps onto whole output pixels,
+        # this gives exactly the same pixels as resizing the full screen
+        px, py = w // math.gcd(w, target[0]), h // math.gcd(h, target[1])
+        if px > self.tilesize or py > self.tilesize:
+            self.base = self.resize(bgra, dimension)
+            return True
+        for x, y, tw, th in tiles:
+            x0, x1 = x // px * px, min(w, -(-(x + tw) // px) * px)
+            y0, y1 = y // py * py, min(h, -(-(y + th) // py) * py)
+            dx0, dx1 = x0 * target[0] // w, x1 * target[0] // w
+            dy0, dy1 = y0 * target[1] // h, y1 * target[1] // h
+            if dimension is None:
+                self.base[dy0:dy1, dx0:dx1] = bgra[y0:y1, x0:x1, :3]
+            else:
+                self.base[dy0:dy1, dx0:dx1] = cv2.resize(bgra[y0:y1, x0:x1], (dx1 - dx0, dy1 - dy0), interpolation=cv2.INTER_AREA)[:, :, :3]
+        return True
+
+    def capture(self, bgra):
+        # update the downscaled screen without cursor, returns whether it changed
+        dimension = self.scale(bgra)
+        if self.tilesize <= 0 or self.base is None:
+            self.changed = [(0, 0, bgra.shape[1], bgra.shape[0])]
+            self.base = self.resize(bgra, dimension)
+            changed = True
+        else:
+            changed = self.updateBase(bgra, dimension)
+        self.scalefactor = self.base.shape[1] / bgra.shape[1]
+        self.grabs += 1
+        if self.grabs % 300 == 0 and self.tilesize > 0:
+            logging.debug("desktop: {:.1f}% of tiles unchanged".format(100 * self.skippedtiles / max(1, self.tiles)))
+        return changed
+
+    def composite(self, changed):
+        scale = self.scalefactor
+        if self.sprite is None or self.sprite[1] != scale:
+            self.createSprite(scale)
+        cursor = self.cursorPosition(self.base, scale)
+        if changed == False and cursor == self.cursor and self.output is not None:
+            # nothing changed, hand out the same frame so layer and compositor can skip it
+            return self.output
+        # published frames are never written to again, draw the cursor on a copy
+        self.cursor = cursor
+        self.output = self.base.copy()
+        self.drawCursor(self.output, scale, cursor)
+        return self.output
+
+    def process(self, bgra):
+        if self.tilesize <= 0:
+            # the base is rebuilt on every grab, no need to keep it free of the cursor
+            self.capture(bgra)
+            self.output = self.base
+            self.drawCursor(self.output, self.scalefactor)
+            return self.output
+        return self.composite(self.capture(bgra))
+
+    def grab(self):
+        # wrap the BGRA buffer of mss without copying it
+        shot = self.sct.grab(self.area)
+        return np.frombuffer(shot.raw, np.uint8).reshape(shot.height, shot.width, 4)
+
+    def suspend(self):
+        # the capture thread waits until the layer needs the screen again
+        self.suspended = True
+        self.active.clear()
+
+    def resume(self):
+        self.suspended = False
+        self.active.set()
+
+    def run(self):
+        self.sct = mss.mss()
+        pacer = Pacer(1 / self.capturefps)
+        while self.dorun == True:
+            if not self.active.is_set():
+                self.active.wait()
+                pacer.restart()
+                continue
+            bgra = self.grab()
+            self.lock.acquire()
+            try:
+                if self.capture(bgra):
+                    self.dirty = True
+            finally:
+                self.lock.release()
+            self.captured.set()
+            pacer.wait(1 / self.capturefps)
+        self.sct = None
+
+    def next(self):
+        if self.capturefps <= 0:
+            return (True, self.process(self.grab()), None)
+        if self.t is None:
+            self.start()
+        # only the cursor is updated at the output rate
+        if not self.captured.wait(1.0):
+            return (True, None, None)
+        self.lock.acquire()
+        try:
+            if self.base is None:
+                return (True, self.output, None)
+            frame = self.composite(self.dirty)
+            self.dirty = False
+        finally:
+            self.lock.release()
         return (True, frame, None)
 
 
@@ -347,7 +793,9 @@ class TextProvider(Provider):
 
     def __init__(self, text="empty", **kwargs):
         self.dx = 0
+        self.resized = None
         kwargs['text'] = text
+        kwargs.setdefault('font', cv2.FONT_HERSHEY_SIMPLEX)
         kwargs.setdefault('size', 3)
         kwargs.setdefault('thickness', 3)
         kwargs.setdefault('fgcolor', (0, 255, 0))
@@ -358,6 +806,8 @@ class TextProvider(Provider):
         super().setParams(kwargs)
         if 'text' in kwargs:
             self.text = kwargs['text']
+        if 'font' in kwargs:
+            self.font = kwargs['font']
         if 'size' in kwargs:
             self.size = kwargs['size']
         if 'thickness' in kwargs:
@@ -372,18 +822,22 @@ class TextProvider(Provider):
 
     def reset(self):
         self.stop()
-        (width, height), baseline = cv2.getTextSize(self.text, cv2.FONT_HERSHEY_SIMPLEX, self.size, self.thickness)
+        self.render()
+
+    def render(self):
+        # assemble the text from cached glyphs instead of rasterizing it twice
+        atlas = getAtlas(self.font, self.size, self.thickness)
+        baseline = atlas.textSize(self.text)[1]
+        mask = atlas.render(self.text)
         if self.bgcolor is not None:
             pad = baseline // 4
-            self.frame = np.zeros((height + baseline + pad*2, width + pad*2, 3), np.uint8)
-            self.frame[:,:] = self.bgcolor
-            cv2.putText(self.frame, self.text, (pad, height - 1 + pad), cv2.FONT_HERSHEY_SIMPLEX, self.size, self.fgcolor, self.thickness)
+            mask = cv2.copyMakeBorder(mask, pad, pad, pad, pad, cv2.BORDER_CONSTANT, None, 0)
+            self.frame = colorize(mask, self.fgcolor, self.bgcolor)
             self.mask = None
         else:
-            self.frame = np.zeros((height + baseline, width, 3), np.uint8)
-            cv2.putText(self.frame, self.text, (0, height - 1), cv2.FONT_HERSHEY_SIMPLEX, self.size, self.fgcolor, self.thickness)
-            self.mask = np.zeros((height + baseline, width, 1), np.uint8)
-            cv2.putText(self.mask, self.text, (0, height - 1), cv2.FONT_HERSHEY_SIMPLEX, self.size, (255), self.thickness)
+            self.frame = colorize(mask, self.fgcolor)
+            self.mask = mask
+        self.resized = None
 
     def next(self):
         frame, mask = self.frame, self.mask
@@ -396,18 +850,29 @@ class TextProvider(Provider):
                 self.height = self.width * frame.shape[0] // frame.shape[1]
             elif self.height > 0:
                 self.width = self.height * frame.shape[1] // frame.shape[0]
-            frame = cv2.resize(frame, (self.width, self.height))
-            if mask is not None:
-                mask = cv2.resize(mask, (self.width, self.height))
+            # keep the resized text until the text or the layer size changes
+            if self.resized is None or self.resized[0] != (self.width, self.height):
+                frame = cv2.resize(frame, (self.width, self.height))
+                if mask is not None:
+                    mask = cv2.resize(mask, (self.width, self.height))
+                self.resized = ((self.width, self.height), frame, mask)
+            frame, mask = self.resized[1:]
         return (True, frame, mask)
 
 
 class CommandlineProvider(TextProvider):
 
     def __init__(self, clicommand=['date', '+%T'], frequency=1.0, **kwargs):
-        self.t = 0
+        self.t = None
+        self.process = None
+        self.output = None
+        self.outputlock = threading.Lock()
+        self.processlock = threading.Lock()
+        self.stopped = threading.Event()
         kwargs['clicommand'] = clicommand
         kwargs['frequency'] = frequency
+        kwargs.setdefault('timeout', 5.0)
+        kwargs.setdefault('stream', False)
         super().__init__(**kwargs)
 
     def setParams(self, kwargs):
@@ -416,24 +881,120 @@ class CommandlineProvider(TextProvider):
             self.clicommand = kwargs.pop('clicommand', None)
         if 'frequency' in kwargs:
             self.frequency = kwargs.pop('frequency', None)
+        # commands running longer than timeout are killed, the last output stays
+        if 'timeout' in kwargs:
+            self.timeout = kwargs.pop('timeout', None)
+        # stream keeps a single process running and shows every line it prints
+        if 'stream' in kwargs:
+            self.stream = kwargs.pop('stream', False)
+
+    def stop(self):
+        self.stopped.set()
+        self.kill()
+        if self.t is not None:
+            self.t.join()
+            self.t = None
+
+    def reset(self):
+        super().reset()
+        self.stop()
+        self.stopped.clear()
+
+    def start(self):
+        # the command is started by the first call of next(), not while the layer is built
+        self.t = threading.Thread(target=self.runStream if self.stream else self.runPoll, name="commandline", daemon=True)
+        self.t.start()
+
+    def spawn(self):
+        # stop() sets stopped before it kills under the same lock, a process is either never
+        # started or seen by kill(). None once stopped
+        self.processlock.acquire()
+        try:
+            if self.stopped.is_set():
+                return None
+            self.process = subprocess.Popen(self.clicommand, stdout=subprocess.PIPE, start_new_session=True)
+            return self.process
+        finally:
+            self.processlock.release()
+
+    def kill(self):
+        # kill the whole process group, shell scripts leave their children running otherwise
+        self.processlock.acquire()
+        try:
+            process = self.process
+            if process is not None and process.poll() is None:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    process.kill()
+        finally:
+            self.processlock.release()
+
+    def setOutput(self, output):
+        self.outputlock.acquire()
+        try:
+            self.output = output
+        finally:
+            self.outputlock.release()
+
+    def runPoll(self):
+        while not self.stopped.is_set():
+            t = time.monotonic()
+            try:
+                if self.spawn() is None:
+                    break
+                output, _ = self.process.communicate(timeout=self.timeout)
+                if self.process.returncode == 0:
+                    self.setOutput(output.decode("utf-8").replace('\n', ''))
+                elif not self.stopped.is_set():
+                    logging.warning("{} exited with {}".format(self.clicommand, self.process.returncode))
+            except subprocess.TimeoutExpired:
+                self.kill()
+                self.process.communicate()
+                logging.warning("{} timed out after {} s".format(self.clicommand, self.timeout))
+            except OSError as e:
+                logging.warning("{} failed: {}".format(self.clicommand, e))
+            self.stopped.wait(max(0, t + self.frequency - time.monotonic()))
+
+    def runStream(self):
+        while not self.stopped.is_set():
+            try:
+                if self.spawn() is None:
+                    break
+            except OSError as e:
+                logging.warning("{} failed: {}".format(self.clicommand, e))
+                self.stopped.wait(self.frequency)
+                continue
+            for line in self.process.stdout:
+                self.setOutput(line.decode("utf-8").replace('\n', ''))
+            self.process.wait()
+            if not self.stopped.is_set():
+                # restart the command if it ended on its own
+                logging.warning("{} exited with {}".format(self.clicommand, self.process.returncode))
+                self.stopped.wait(self.frequency)
 
     def next(self):
-        t = time.time()
-        if t - self.t > self.frequency:
-            output = subprocess.check_output(self.clicommand).decode("utf-8").replace('\n', '')
+        if self.t is None and not self.stopped.is_set():
+            self.start()
+        # the command runs in the background, show the last output it produced
+        self.outputlock.acquire()
+        try:
+            output = self.output
+        finally:
+            self.outputlock.release()
+        if output is not None and output != self.text:
             self.setParams({'text': output})
-            self.reset()
-            self.t = t
+            self.render()
         return super().next()
 
 
 class Frequency(Provider):
 
     def __init__(self, fps, provider, **kwargs):
-        self.time = 0
         kwargs['provider'] = provider
         kwargs['fps'] = fps
         super().__init__(**kwargs)
+        self.pacer = Pacer()
 
     def setParams(self, kwargs):
         super().setParams(kwargs)
@@ -453,11 +1014,8 @@ class Frequency(Provider):
 
     def next(self):
         ret, frame, mask = self.provider.next()
-        # delay returning frame
-        sleep = self.time + self.frametime - time.time()
-        if sleep > 0:
-            time.sleep(sleep)
-        self.time = time.time()
+        # a late frame moves on to the next deadline instead of delaying all following ones
+        self.pacer.wait(self.frametime)
         return (ret, frame, mask)
 
 
@@ -490,6 +1048,9 @@ class OnPress(Provider):
     def __init__(self, key, provider, **kwargs):
         self.lasttriggercount = 0
         self.triggercount = 0
+        self.suspended = False
+        self.warmuntil = 0
+        kwargs.setdefault('warmup', 0)
         kwargs['key'] = key
         kwargs['provider'] = provider
         super().__init__(**kwargs)
@@ -498,6 +1059,9 @@ class OnPress(Provider):
         super().setParams(kwargs)
         if 'key' in kwargs:
             self.key = kwargs.pop('key', ord(' '))
+        # seconds of upstream frames that are not shown after it is resumed
+        if 'warmup' in kwargs:
+            self.warmup = kwargs.pop('warmup', 0)
         self.provider.setParams(kwargs)
 
     def stop(self):
@@ -512,6 +1076,11 @@ class OnPress(Provider):
             if self.lasttriggercount > 0:
                 self.triggercount = 0
                 self.lasttriggercount = 0
+            # upstream is suspended while nothing is shown, wake it up before it is reset
+            if self.triggercount > 0 and self.suspended:
+                self.provider.resume()
+                self.suspended = False
+                self.warmuntil = now() + self.warmup
             self.provider.reset()
             self.lasttriggercount = self.triggercount
         if self.triggercount > 0:
@@ -519,10 +1088,22 @@ class OnPress(Provider):
             if ret == False:
                 self.triggercount = 0
                 self.lasttriggercount = 0
+            elif now() < self.warmuntil:
+                frame, mask = (None, None)
         else:
-            time.sleep(0.033)
+            if not self.suspended:
+                self.provider.suspend()
+                self.suspended = True
+            # sleep until the layer receives a command
+            if self.events is not None:
+                self.events.wait(1.0)
+            else:
+                time.sleep(0.033)
         return (True, frame, mask)
 
+    def accepts(self, **kwargs):
+        return kwargs.get('keypress', -1) == self.key or super().accepts(**kwargs)
+
     def command(self, **kwargs):
         if kwargs.get('keypress', -1) == self.key:
             kwargs.pop('keypress', None)
@@ -539,9 +1120,16 @@ class Boomerang(Provider):
         TRANSITION = 3
 
     def __init__(self, duration, key, provider, **kwargs):
-        self.frames = collections.deque([])
+        self.frames = None
         self.status = Boomerang.Status.INACTIVE
+        self.replay = Pacer()
+        self.suspended = False
+        self.resumetime = None
         kwargs.setdefault('fakelagduration', 1.0)
+        kwargs.setdefault('warmup', 0)
+        kwargs.setdefault('fps', 30)
+        kwargs.setdefault('storage', 'memory')
+        kwargs.setdefault('maxbytes', 256 << 20)
         kwargs['duration'] = duration
         kwargs['key'] = key
         kwargs['provider'] = provider
@@ -549,12 +1137,37 @@ class Boomerang(Provider):
 
     def setParams(self, kwargs):
         super().setParams(kwargs)
+        allocate = False
         if 'duration' in kwargs:
             self.duration = kwargs.pop('duration', 2)
+            allocate = True
         if 'key' in kwargs:
             self.key = kwargs.pop('key', ord(' '))
         if 'fakelagduration' in kwargs:
             self.fakelagduration = kwargs.pop('fakelagduration', 0)
+        # seconds upstream has to deliver frames again before the replay ends
+        if 'warmup' in kwargs:
+            self.warmup = kwargs.pop('warmup', 0)
+        if 'fps' in kwargs:
+            self.fps = kwargs.pop('fps', 30)
+            allocate = True
+        if 'storage' in kwargs:
+            # memory: raw frames, jpeg: compressed in memory, disk: memory-mapped temporary file.
+            # any of them keeps fewer than duration seconds rather than taking more than maxbytes
+            self.storage = kwargs.pop('storage', 'memory')
+            allocate = True
+        if 'maxbytes' in kwargs:
+            self.maxbytes = kwargs.pop('maxbytes', 256 << 20)
+            allocate = True
+        # the history is preallocated for duration at the expected fps
+        if allocate:
+            capacity = int(np.ceil(self.duration * self.fps)) + 1
+            if self.storage == 'jpeg':
+                self.frames = CompressedRing(capacity, self.maxbytes)
+            elif self.storage == 'disk':
+                self.frames = DiskRing(capacity, self.maxbytes, cache.directory)
+            else:
+                self.frames = FrameRing(capacity, self.maxbytes)
         self.provider.setParams(kwargs)
 
     def stop(self):
@@ -563,50 +1176,78 @@ class Boomerang(Provider):
     def reset(self):
         self.provider.reset()
 
-    def next(self):
-        ret, frame, mask = self.provider.next()
-        t = time.time()
-        # save frames
-        self.frames.append({'frame': frame, 'mask': mask, 'time': t})
-        while self.frames[0]['time'] + self.duration < t:
-            self.frames.popleft()
+    def getPacer(self):
+        if self.status == Boomerang.Status.ACTIVE:
+            return self.replay
+        return super().getPacer()
+
+    def advance(self):
+        # move back and forth through the snapshot, returns the recorded time between the frames
+        if self.boomerangidx == 0 or self.boomerangidx == len(self.boomerang) - 1:
+            self.boomerangidx, self.boomeranglastidx = self.boomeranglastidx, self.boomerangidx
+        else:
+            tmp = self.boomerangidx
+            self.boomerangidx += 1 if self.boomerangidx >= self.boomeranglastidx else -1
+            self.boomeranglastidx = tmp
+        return abs(self.boomerang.time(self.boomerangidx) - self.boomerang.time(self.boomeranglastidx))
 
+    def next(self):
+        # upstream is suspended while the replay is shown and resumed on the transition back
+        frame, mask = (None, None)
         if self.status == Boomerang.Status.ACTIVE:
-            frame = self.boomerang[len(self.boomerang)-1-self.boomerangidx]['frame']
-            mask = self.boomerang[len(self.boomerang)-1-self.boomerangidx]['mask']
-            if self.boomerangidx == 0 or self.boomerangidx == len(self.boomerang) - 1:
-                self.boomerangidx, self.boomeranglastidx = self.boomeranglastidx, self.boomerangidx
-            else:
-                tmp = self.boomerangidx
-                self.boomerangidx += 1 if self.boomerangidx >= self.boomeranglastidx else -1
-                self.boomeranglastidx = tmp
-            
-            # sleep until t + delta
-            future = self.t + abs(self.boomerang[self.boomerangidx]['time'] - self.boomerang[self.boomeranglastidx]['time'])
-            sleep = future - time.time()
-            if sleep > 0:
-                time.sleep(sleep)
+            if not self.suspended:
+                self.provider.suspend()
+                self.suspended = True
+            ret = True
+        else:
+            if self.suspended:
+                self.provider.resume()
+                self.suspended = False
+                self.resumetime = None
+            ret, frame, mask = self.provider.next()
+            if self.resumetime is None and frame is not None:
+                self.resumetime = now()
+        t = now()
+        # save frames, the snapshot being played back points into the ring
+        if self.status == Boomerang.Status.INACTIVE:
+            if frame is not None:
+                self.frames.append(frame, mask, t, self.provider.getTrace())
+            self.frames.trim(t - self.duration)
+
+        self.trace = None
+        if self.status == Boomerang.Status.ACTIVE:
+            current = self.boomerang[len(self.boomerang)-1-self.boomerangidx]
+            frame, mask, self.trace = current['frame'], current['mask'], current['trace']
+            # play back at the recorded speed, late steps skip stored frames
+            for i in range(self.replay.wait(self.advance())):
+                self.advance()
             ret = True
         elif self.status == Boomerang.Status.TRANSITION:
-            if t < self.triggertime + self.fakelagduration:
-                frame = self.boomerang[len(self.boomerang)-1-self.boomerangidx]['frame']
-                mask = self.boomerang[len(self.boomerang)-1-self.boomerangidx]['mask']
+            # keep showing the replay until upstream has warmed up, there is no gap on return
+            if t < self.triggertime + self.fakelagduration or self.resumetime is None or t < self.resumetime + self.warmup:
+                current = self.boomerang[len(self.boomerang)-1-self.boomerangidx]
+                frame, mask, self.trace = current['frame'], current['mask'], current['trace']
             else:
                 self.status = Boomerang.Status.INACTIVE
-        self.t = t
         return (ret, frame, mask)
 
+    def accepts(self, **kwargs):
+        return kwargs.get('keypress', -1) == self.key or super().accepts(**kwargs)
+
     def command(self, **kwargs):
         if kwargs.get('keypress', -1) == self.key:
             kwargs.pop('keypress', None)
             if self.status == Boomerang.Status.INACTIVE or self.status == Boomerang.Status.TRANSITION:
+                if len(self.frames) < 2:
+                    return True
                 self.status = Boomerang.Status.ACTIVE
                 self.boomerangidx = 1
                 self.boomeranglastidx = 0
-                self.boomerang = self.frames.copy()
+                self.boomerang = self.frames.snapshot()
+                self.replay.restart()
             elif self.status == Boomerang.Status.ACTIVE:
                 self.status = Boomerang.Status.TRANSITION
-            self.triggertime = time.time()
+            self.triggertime = now()
             logging.info("Set boomerang to: {}".format(self.status))
             return True
         return super().command(**kwargs)
@@ -616,19 +1257,30 @@ class HorizontalShift(Provider):
 
     def __init__(self, provider, **kwargs):
         self.dx = 0
+        self.starttime = None
+        self.source = (None, None)
+        self.strip = None
+        self.stripmask = None
+        self.output = (None, None, None)
         kwargs.setdefault('speed', 3)
+        kwargs.setdefault('velocity', 0)
         kwargs.setdefault('padpercentage', 0.5)
         kwargs['provider'] = provider
         super().__init__(**kwargs)
 
     def setParams(self, kwargs):
         super().setParams(kwargs)
+        # speed moves by pixels per frame, velocity by pixels per second independent of the fps
         if 'speed' in kwargs:
             self.speed = kwargs.pop('speed', None)
+        if 'velocity' in kwargs:
+            self.velocity = kwargs.pop('velocity', 0)
         if 'dimension' in kwargs:
             kwargs['dimension'] = (-1, -1)
+            self.strip = None
         if 'padpercentage' in kwargs:
             self.padpercentage = kwargs.pop('padpercentage', None)
+            self.strip = None
         self.provider.setParams(kwargs)
 
     def stop(self):
@@ -637,91 +1289,328 @@ class HorizontalShift(Provider):
     def reset(self):
         self.provider.reset()
 
+    def build(self, frame, mask):
+        # one period is the source followed by pad empty pixels, or the source on an empty canvas
+        # if it is narrower than the layer. the strip repeats the period for one more window,
+        # so every window is a view into the strip
+        if frame.shape[0] != self.height:
+            width = frame.shape[1] * self.height // frame.shape[0]
+            frame = cv2.resize(frame, (width, self.height))
+        if mask is not None and mask.shape[:2] != frame.shape[:2]:
+            mask = cv2.resize(mask, (frame.shape[1], frame.shape[0]))
+        self.period = max(frame.shape[1], self.width) + int(self.width * self.padpercentage)
+        # sources wider than the layer scroll to the left, narrower ones to the right
+        self.direction = 1 if frame.shape[1] > self.width else -1
+        columns = np.arange(self.period + self.width + 1) % self.period
+        period = np.zeros((self.height, self.period, 3), np.uint8)
+        period[:, :frame.shape[1]] = frame
+        self.strip = period[:, columns]
+        self.stripmask = None
+        if mask is not None or self.period > frame.shape[1]:
+            period = np.zeros((self.height, self.period), np.uint8)
+            period[:, :frame.shape[1]] = 255 if mask is None else mask
+            self.stripmask = period[:, columns]
+        self.output = (None, None, None)
+
+    def blend(self, x, alpha):
+        # linear interpolation between the windows at x and x + 1. every blended frame is a new array,
+        # published frames are shared with other layers and must not be written to afterwards
+        frame = cv2.addWeighted(self.strip[:, x:x+self.width], 1 - alpha, self.strip[:, x+1:x+1+self.width], alpha, 0)
+        if self.stripmask is None:
+            return (frame, None)
+        mask = cv2.addWeighted(self.stripmask[:, x:x+self.width], 1 - alpha, self.stripmask[:, x+1:x+1+self.width], alpha, 0)
+        return (frame, mask)
+
     def next(self):
         ret, frame, mask = self.provider.next()
         if frame is None or (self.width <= 0 and self.height <= 0):
+            return (ret, frame, mask)
+        if self.width > 0 and self.height > 0:
             pass
-        else:
-            if self.width > 0 and self.height > 0:
-                pass
-            elif self.width > 0:
-                self.height = frame.shape[0]
-            elif self.height > 0:
-                frame = cv2.resize(frame, (frame.shape[1] * self.height // frame.shape[0], self.height))
-                self.width = frame.shape[1]
-
-            pad = int(self.width * self.padpercentage)
-
-            res = np.zeros((self.height, self.width, 3), dtype=np.uint8)
-            rmask = np.zeros((self.height, self.width), dtype=np.uint8)
-            frame = cv2.resize(frame, (frame.shape[1] * self.height // frame.shape[0], self.height))
-            if mask is not None:
-                mask = cv2.resize(mask, (frame.shape[1] * self.height // frame.shape[0], self.height))
-
-            if frame.shape[1] > self.width:
-                if mask is None and pad > 0:
-                    mask = np.zeros((frame.shape[0], frame.shape[1]), np.uint8) + 255
-                frame = cv2.copyMakeBorder(frame, 0, 0, 0, pad, cv2.BORDER_CONSTANT, None, 0)
-                d1 = self.dx % frame.shape[1]
-                d2 = d1 + self.width
-                d3, d4 = 0, 0
-                if d2 > frame.shape[1]:
-                    d4 = d2 - frame.shape[1]
-                    d2 = frame.shape[1]
-                res[:, :(d2-d1), :] = frame[:, d1:d2, :]
-                res[:, (d2-d1):, :] = frame[:, d3:d4, :]
-                rmask[:, :] = 255
-                if mask is not None:
-                    mask = cv2.copyMakeBorder(mask, 0, 0, 0, pad, cv2.BORDER_CONSTANT, None, 0)
-                    rmask[:, :(d2-d1)] = mask[:, d1:d2]
-                    rmask[:, (d2-d1):] = mask[:, d3:d4]
-            else:
-                res = cv2.copyMakeBorder(res, 0, 0, 0, pad, cv2.BORDER_CONSTANT, None, 0)
-                rmask = cv2.copyMakeBorder(rmask, 0, 0, 0, pad, cv2.BORDER_CONSTANT, None, 0)
-                d1 = self.dx % res.shape[1]
-                d2 = d1 + frame.shape[1]
-                d3, d4 = 0, 0
-                if d2 > res.shape[1]:
-                    d4 = d2 - res.shape[1]
-                    d2 = res.shape[1]
-                res[:, d1:d2, :] = frame[:, :(d2-d1), :]
-                res[:, d3:d4, :] = frame[:, (d2-d1):, :]
-                rmask[:, d1:d2] = 255
-                rmask[:, d3:d4] = 255
-                if mask is not None:
-                    rmask[:, d1:d2] = mask[:, :(d2-d1)]
-                    rmask[:, d3:d4] = mask[:, (d2-d1):]
-                if pad > 0:
-                    res = res[:, :-pad, :]
-                    rmask = rmask[:, :-pad]
-
+        elif self.width > 0:
+            self.height = frame.shape[0]
+        elif self.height > 0:
+            self.width = frame.shape[1] * self.height // frame.shape[0]
+
+        # static sources return the same frame, the strip is only rebuilt if it changes
+        if self.strip is None or frame is not self.source[0] or mask is not self.source[1] \
+            or self.strip.shape[0] != self.height or self.strip.shape[1] != self.period + self.width + 1:
+            self.build(frame, mask)
+            self.source = (frame, mask)
+
+        if self.velocity > 0:
+            t = now()
+            if self.starttime is None:
+                self.starttime = t
+            self.dx = self.velocity * (t - self.starttime)
+        offset = (self.direction * self.dx) % self.period
+        if self.velocity <= 0:
             self.dx += self.speed
-            frame = res
-            mask = rmask
+        x = int(offset)
+        alpha = offset - x
+        # quantize the sub-pixel position, 1/32 pixel is not visible
+        alpha = round(alpha * 32) / 32
+        if alpha == 1:
+            x, alpha = (x + 1) % self.period, 0
+        if self.output[0] == (x, alpha):
+            return (ret, self.output[1], self.output[2])
+        if alpha == 0:
+            frame = self.strip[:, x:x+self.width]
+            mask = None if self.stripmask is None else self.stripmask[:, x:x+self.width]
+        else:
+            frame, mask = self.blend(x, alpha)
+        self.output = ((x, alpha), frame, mask)
         return (ret, frame, mask)
 
 
-class BodypixProvider(Provider):
-
-    def __init__(self, provider, **kwargs):
+class SegmentationProvider(Provider):
+
+    def __init__(self, provider, backend=None, **kwargs):
+        self.backend = None
+        self.workers = []
+        self.dorun = False
+        self.cond = threading.Condition()
+        self.job = None
+        self.result = None
+        self.seq = 0
+        self.skipped = 0
+        self.frames = 0
+        self.maskage = 0
+        self.reference = None
+        self.reused = 0
+        self.segmented = 0
+        self.warped = 0
+        self.smoothed = None
+        self.budget = None
+        self.breaker = CircuitBreaker()
+        self.timeouts = 0
+        self.fallbacks = 0
+        kwargs.setdefault('inflight', 2)
+        kwargs.setdefault('motionthreshold', 1.5)
+        kwargs.setdefault('segmentevery', 5)
+        kwargs.setdefault('warp', True)
+        kwargs.setdefault('smoothing', 0.5)
+        kwargs.setdefault('budget', 0.5)
+        if backend is not None:
+            kwargs['backend'] = backend
         kwargs['provider'] = provider
         super().__init__(**kwargs)
 
     def setParams(self, kwargs):
         super().setParams(kwargs)
+        # a SegmentationBackend from src.Segmentation
+        if 'backend' in kwargs:
+            if self.backend is not None:
+                self.backend.close()
+            self.backend = kwargs.pop('backend', None)
+        # number of frames segmented at the same time, 0 segments every frame before returning it
+        if 'inflight' in kwargs:
+            self.inflight = kwargs.pop('inflight', 2)
+        # frames that differ from the last segmented one by less than motionthreshold gray levels on average
+        # reuse its mask, shifted by the measured motion if warp is set. every segmentevery-th frame is
+        # segmented regardless. smoothing is the weight of the previous mask in the shown one
+        if 'motionthreshold' in kwargs:
+            self.motionthreshold = kwargs.pop('motionthreshold', 1.5)
+        if 'segmentevery' in kwargs:
+            self.segmentevery = max(1, kwargs.pop('segmentevery', 5))
+        if 'warp' in kwargs:
+            self.warp = kwargs.pop('warp', True)
+        if 'smoothing' in kwargs:
+            self.smoothing = kwargs.pop('smoothing', 0.5)
+        # seconds a request may take, None waits as long as it takes. late masks count as failures,
+        # after failures of them in a row the backend is left alone for backoff seconds, doubling
+        # while it keeps failing. the last good mask is shown meanwhile
+        if 'budget' in kwargs:
+            self.budget = kwargs.pop('budget', 0.5)
+        if 'failures' in kwargs:
+            self.breaker.failures = kwargs.pop('failures', 3)
+        if 'backoff' in kwargs:
+            self.breaker.backoff = self.breaker.delay = kwargs.pop('backoff', 1.0)
+        # frames are segmented at the size they come in and resized here, the source may still
+        # pick a capture resolution close to the size of the layer
+        if 'dimension' in kwargs:
+            kwargs['sizehint'] = kwargs['dimension']
         kwargs['dimension'] = (-1, -1)
         self.provider.setParams(kwargs)
 
     def stop(self):
+        self.cond.acquire()
+        try:
+            self.dorun = False
+            self.job = None
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.result = None
+        self.reference = None
+        self.smoothed = None
+        if self.backend is not None:
+            self.backend.close()
         self.provider.stop()
 
     def reset(self):
         self.provider.reset()
 
+    def start(self):
+        self.dorun = True
+        for i in range(self.inflight):
+            worker = threading.Thread(target=self.run, name="segment{}".format(i), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                self.cond.wait_for(lambda: self.job is not None or self.dorun == False)
+                if self.dorun == False:
+                    return
+                seq, frame, t, thumbnail = self.job
+                self.job = None
+            finally:
+                self.cond.release()
+            mask = self.request(frame)
+            if mask is None:
+                self.fallbacks += 1
+                continue
+            # with several requests in flight masks may arrive out of order, keep the newest
+            self.cond.acquire()
+            try:
+                if self.result is None or seq > self.result[0]:
+                    self.result = (seq, mask, t, thumbnail)
+                    self.cond.notify_all()
+            finally:
+                self.cond.release()
+
+    def segment(self, frame, t, thumbnail):
+        # hand the frame to the next free worker and return the newest mask available.
+        # a frame still waiting for a worker is replaced, only the first mask is waited for
+        self.cond.acquire()
+        try:
+            if self.job is not None:
+                self.skipped += 1
+            self.seq += 1
+            self.job = (self.seq, frame, t, thumbnail)
+            self.cond.notify_all()
+            self.cond.wait_for(lambda: self.result is not None or self.dorun == False, 1.0 if self.budget is None else self.budget)
+            return self.result
+        finally:
+            self.cond.release()
+
+    def request(self, frame):
+        # mask of frame or None if the backend failed
+        t = time.monotonic()
+        try:
+            mask = self.getMask(frame)
+        except TimeoutError:
+            self.timeouts += 1
+            self.breaker.failure()
+            return None
+        except Exception as e:
+            logging.warning("segmentation failed: {}".format(e))
+            self.breaker.failure()
+            return None
+        # a late mask is still newer than the last good one, use it but count it against the backend
+        if self.budget is not None and time.monotonic() - t > self.budget:
+            self.timeouts += 1
+            self.breaker.failure()
+        else:
+            self.breaker.success()
+        return mask
+
+    def latest(self):
+        self.cond.acquire()
+        try:
+            return self.result
+        finally:
+            self.cond.release()
+
+    def thumbnail(self, frame):
+        # motion is measured on a small grayscale copy, it is cheap and ignores sensor noise
+        small = cv2.resize(frame, (64, max(1, 64 * frame.shape[0] // frame.shape[1])), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype(np.float32)
+
+    def needsSegmentation(self, thumbnail):
+        if self.reference is None or self.reference[0].shape != thumbnail.shape:
+            return True
+        if self.reference[1] + 1 >= self.segmentevery:
+            return True
+        return cv2.absdiff(thumbnail, self.reference[0]).mean() >= self.motionthreshold
+
+    def warpMask(self, mask, source, thumbnail):
+        # shift the mask by the translation between the frame it was segmented from and this one
+        (dx, dy), response = cv2.phaseCorrelate(source, thumbnail)
+        scale = mask.shape[1] / thumbnail.shape[1]
+        dx, dy = dx * scale, dy * scale
+        if response < 0.1 or (abs(dx) < 0.5 and abs(dy) < 0.5):
+            return mask
+        self.warped += 1
+        matrix = np.float32([[1, 0, dx], [0, 1, dy]])
+        return cv2.warpAffine(mask, matrix, (mask.shape[1], mask.shape[0]), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+    def smoothMask(self, mask):
+        # exponential moving average over the shown masks hides flicker at the edges
+        if self.smoothing <= 0:
+            return mask
+        if self.smoothed is None or self.smoothed.shape != mask.shape:
+            self.smoothed = mask
+        else:
+            self.smoothed = cv2.addWeighted(self.smoothed, self.smoothing, mask, 1 - self.smoothing, 0)
+        return self.smoothed
+
     def next(self):
         ret, frame, mask = self.provider.next()
         if frame is not None:
-            mask = self.getMask(frame)
+            t = time.monotonic()
+            trace = self.getTrace()
+            capturetime = t if trace is None else trace.capturetime
+            thumbnail = self.thumbnail(frame)
+            # segment only if the frame changed enough since the last segmented one
+            due = self.needsSegmentation(thumbnail)
+            if due and not self.breaker.allow():
+                # the backend is failing, keep the last good mask until it is tried again
+                self.fallbacks += 1
+                result = self.result if self.inflight <= 0 else self.latest()
+            elif due:
+                self.reference = (thumbnail, 0)
+                self.segmented += 1
+                if self.inflight <= 0:
+                    mask = self.request(frame)
+                    if mask is not None:
+                        self.result = (0, mask, capturetime, thumbnail)
+                    else:
+                        self.fallbacks += 1
+                    result = self.result
+                else:
+                    if len(self.workers) == 0:
+                        self.start()
+                    result = self.segment(frame, capturetime, thumbnail)
+            else:
+                self.reference = (self.reference[0], self.reference[1] + 1)
+                self.reused += 1
+                result = self.result if self.inflight <= 0 else self.latest()
+            if result is None:
+                return (ret, None, None)
+            # the mask stays at the resolution of the backend, it is warped and smoothed there
+            # and scaled up once by the compositor
+            _, mask, masktime, source = result
+            if self.warp and masktime != capturetime and source.shape == thumbnail.shape:
+                mask = self.warpMask(mask, source, thumbnail)
+            mask = self.smoothMask(mask)
+            # the mask belongs to an earlier frame if it was reused or the next ones are being segmented
+            self.maskage = 0.9 * self.maskage + 0.1 * (capturetime - masktime)
+            if trace is not None:
+                trace.age('maskage', capturetime - masktime)
+                trace.mark('segment', time.monotonic() - t)
+            self.frames += 1
+            if self.frames % 300 == 0:
+                logging.debug("segmentation: {} of {} frames segmented ({:.1f}x fewer), {} masks warped, {} frames not segmented in time, mask age {:.1f} ms".format(
+                    self.segmented, self.frames, self.frames / max(1, self.segmented), self.warped, self.skipped, self.maskage * 1000))
+                logging.debug("segmentation: {} requests over budget, {} frames with the last good mask, backend {} ({} times opened)".format(
+                    self.timeouts, self.fallbacks, self.breaker.state.name.lower(), self.breaker.opened))
             if self.width <= 0 and self.height <= 0:
                 pass
             else:
@@ -731,22 +1620,39 @@ class BodypixProvider(Provider):
                     self.height = self.width * frame.shape[0] // frame.shape[1]
                 elif self.height > 0:
                     self.width = self.height * frame.shape[1] // frame.shape[0]
-                frame = cv2.resize(frame, (self.width, self.height))
-                if mask is not None:
-                    mask = cv2.resize(mask, (self.width, self.height))
+                if frame.shape[1] != self.width or frame.shape[0] != self.height:
+                    frame = cv2.resize(frame, (self.width, self.height))
         return (ret, frame, mask)
 
-    def getMask(self, frame, bodypix_url='http://localhost:9000', scale=0.25):
-        sframe = cv2.resize(frame, (0, 0), fx=scale, fy=scale)
-        _, data = cv2.imencode(".jpg", sframe)
-        r = requests.post(
-            url=bodypix_url,
-            data=data.tobytes(),
-            headers={'Content-Type': 'application/octet-stream'})
-        mask = np.frombuffer(r.content, dtype=np.uint8)
-        mask = mask.reshape((sframe.shape[0], sframe.shape[1])) * 255
-        mask = cv2.resize(mask, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_LINEAR)
-        return mask
+    def getMask(self, frame):
+        return self.backend.segment(frame)
+
+
+class BodypixProvider(SegmentationProvider):
+
+    def __init__(self, provider, **kwargs):
+        self.url = None
+        self.socket = None
+        self.frameformat = None
+        self.maskformat = None
+        kwargs.setdefault('url', 'http://localhost:9000')
+        kwargs.setdefault('socket', os.environ.get('BODYPIX_SOCKET'))
+        kwargs.setdefault('frameformat', 'jpeg')
+        kwargs.setdefault('maskformat', 'bits')
+        super().__init__(provider, **kwargs)
+
+    def setParams(self, kwargs):
+        # the server is reached over http at url, or over the unix socket path if it is set.
+        # frames are sent in frameformat and masks requested in maskformat, see src.Segmentation
+        if any(k in kwargs for k in ('url', 'socket', 'budget', 'frameformat', 'maskformat')):
+            self.url = kwargs.pop('url', self.url)
+            self.socket = kwargs.pop('socket', self.socket)
+            self.frameformat = kwargs.pop('frameformat', self.frameformat)
+            self.maskformat = kwargs.pop('maskformat', self.maskformat)
+            # requests are abandoned once they are over budget
+            kwargs['backend'] = BodypixBackend(self.url, self.socket, timeout=kwargs.get('budget', self.budget),
+                frameformat=self.frameformat, maskformat=self.maskformat)
+        super().setParams(kwargs)
 
 
 class Filter(Provider):
@@ -781,6 +1687,9 @@ class Filter(Provider):
     def applyFilter(self, frame, mask):
         pass
 
+    def accepts(self, **kwargs):
+        return kwargs.get('keypress', -1) == self.key or super().accepts(**kwargs)
+
     def command(self, **kwargs):
         if kwargs.get('keypress', -1) == self.key:
             kwargs.pop('keypress', None)
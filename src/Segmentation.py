@@ -0,0 +1,329 @@
+import abc
+import time
+import socket
+import logging
+import threading
+from enum import Enum
+import http.client
+import numpy as np
+import cv2
+import requests
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socketpath, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socketpath = socketpath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socketpath)
+
+
+# frames are sent as jpeg or as raw rgb or gray pixels.
+# masks come back with one byte per pixel, eight pixels per byte or as alternating runs of
+# background and foreground pixels in little endian uint16
+FRAMEFORMATS = ('jpeg', 'rgb', 'gray')
+MASKFORMATS = ('bytes', 'bits', 'rle')
+
+def packMask(mask, maskformat):
+    # mask holds 0 and 1, this is what the server does
+    mask = mask.reshape(-1)
+    if maskformat == 'bits':
+        return np.packbits(mask).tobytes()
+    if maskformat == 'rle':
+        edges = np.flatnonzero(np.diff(mask)) + 1
+        runs = np.diff(np.concatenate(([0], edges, [mask.size])))
+        if mask[0] != 0:
+            runs = np.concatenate(([0], runs))
+        # runs longer than uint16 are split by an empty run of the other value
+        split = []
+        for run in runs:
+            while run > 0xFFFF:
+                split += [0xFFFF, 0]
+                run -= 0xFFFF
+            split.append(run)
+        return np.array(split, '<u2').tobytes()
+    return mask.astype(np.uint8).tobytes()
+
+def unpackMask(data, maskformat, shape):
+    # 0 or 255 per pixel
+    count = shape[0] * shape[1]
+    if maskformat == 'bits':
+        mask = np.unpackbits(np.frombuffer(data, np.uint8), count=count) * 255
+    elif maskformat == 'rle':
+        runs = np.frombuffer(data, '<u2')
+        values = np.zeros(len(runs), np.uint8)
+        values[1::2] = 255
+        mask = np.repeat(values, runs)
+    else:
+        mask = np.frombuffer(data, np.uint8) * 255
+    return mask.reshape(shape)
+
+
+class BodypixClient(object):
+
+    def __init__(self, url='http://localhost:9000', socketpath=None, timeout=None, poolsize=4, frameformat='jpeg', maskformat='bits'):
+        # keep-alive connections are reused for every frame instead of connecting per request.
+        # a unix socket path skips tcp entirely, app.js listens on it with BODYPIX_SOCKET
+        self.url = url
+        self.socketpath = socketpath
+        self.timeout = timeout
+        # the frame format is used once the server lists it, until then and with older servers
+        # frames are sent as jpeg. masks come back in maskformat if the server supports it
+        self.frameformat = frameformat
+        self.maskformat = maskformat
+        self.frameformats = ('jpeg',)
+        self.sent = 0
+        self.received = 0
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=poolsize)
+        self.session.mount('http://', adapter)
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connection(self):
+        # http.client connections can not be shared, every thread keeps its own.
+        # they are listed as well so close() reaches those of other threads
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = UnixHTTPConnection(self.socketpath, self.timeout)
+            self.local.conn = conn
+            self.lock.acquire()
+            try:
+                self.connections.append(conn)
+            finally:
+                self.lock.release()
+        return conn
+
+    def drop(self, conn):
+        conn.close()
+        self.local.conn = None
+        self.lock.acquire()
+        try:
+            if conn in self.connections:
+                self.connections.remove(conn)
+        finally:
+            self.lock.release()
+
+    def postUnix(self, data, headers):
+        # a kept-alive connection may have been closed by the server in between, retry once on a new one
+        for attempt in (0, 1):
+            conn = self.connection()
+            try:
+                conn.request('POST', '/', body=data, headers=headers)
+                response = conn.getresponse()
+                content = response.read()
+                if response.status != 200:
+                    raise requests.HTTPError("bodypix returned {}".format(response.status))
+                return (content, response.headers)
+            except socket.timeout:
+                # the late answer would be read as the answer to the next request
+                self.drop(conn)
+                raise
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                self.drop(conn)
+                if attempt == 1:
+                    raise
+
+    def request(self, data, headers):
+        # response body and headers, TimeoutError if the server did not answer within timeout
+        try:
+            if self.socketpath is not None:
+                content, responseheaders = self.postUnix(data, headers)
+            else:
+                r = self.session.post(url=self.url, data=data, headers=headers, timeout=self.timeout)
+                r.raise_for_status()
+                content, responseheaders = r.content, r.headers
+        except (socket.timeout, requests.Timeout) as e:
+            raise TimeoutError("bodypix did not answer within {} s".format(self.timeout)) from e
+        self.sent += len(data)
+        self.received += len(content)
+        return (content, responseheaders)
+
+    def post(self, data, headers=None):
+        headers = {'Content-Type': 'application/octet-stream'} if headers is None else headers
+        return self.request(data, headers)[0]
+
+    def encode(self, frame, size):
+        # payload of frame downscaled to size in the best format the server accepts
+        frameformat = self.frameformat if self.frameformat in self.frameformats else 'jpeg'
+        sframe = cv2.resize(frame, size)
+        if frameformat == 'rgb':
+            return ('rgb', cv2.cvtColor(sframe, cv2.COLOR_BGR2RGB).tobytes())
+        if frameformat == 'gray':
+            return ('gray', cv2.cvtColor(sframe, cv2.COLOR_BGR2GRAY).tobytes())
+        return ('jpeg', cv2.imencode(".jpg", sframe)[1].tobytes())
+
+    def segment(self, frame, scale=0.25):
+        # person mask of frame, segmented and returned at scale
+        size = (int(round(frame.shape[1] * scale)), int(round(frame.shape[0] * scale)))
+        frameformat, data = self.encode(frame, size)
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'X-Frame-Format': frameformat,
+            'X-Frame-Size': '{}x{}'.format(size[0], size[1]),
+            'X-Mask-Format': self.maskformat,
+        }
+        content, responseheaders = self.request(data, headers)
+        formats = responseheaders.get('X-Frame-Formats')
+        if formats is not None:
+            self.frameformats = tuple(formats.split(','))
+        return unpackMask(content, responseheaders.get('X-Mask-Format', 'bytes'), (size[1], size[0]))
+
+    def close(self):
+        self.session.close()
+        self.lock.acquire()
+        try:
+            connections, self.connections = self.connections, []
+        finally:
+            self.lock.release()
+        for conn in connections:
+            conn.close()
+        # threads that keep using the client open a new connection
+        self.local = threading.local()
+
+
+class CircuitBreaker(object):
+
+    class State(Enum):
+        CLOSED = 1
+        OPEN = 2
+        HALF_OPEN = 3
+
+    def __init__(self, failures=3, backoff=1.0, maxbackoff=30.0):
+        # after failures failed requests in a row no requests are made for backoff seconds.
+        # then a single request is let through, if it fails too the wait is doubled up to maxbackoff
+        self.failures = failures
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.state = CircuitBreaker.State.CLOSED
+        self.failed = 0
+        self.delay = backoff
+        self.retrytime = 0
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        # True if a request may be made now
+        self.lock.acquire()
+        try:
+            if self.state == CircuitBreaker.State.CLOSED:
+                return True
+            if time.monotonic() < self.retrytime:
+                return False
+            # let one request through. if it never reports back another one is let through after the delay
+            self.state = CircuitBreaker.State.HALF_OPEN
+            self.retrytime = time.monotonic() + self.delay
+            return True
+        finally:
+            self.lock.release()
+
+    def success(self):
+        self.lock.acquire()
+        try:
+            if self.state != CircuitBreaker.State.CLOSED:
+                logging.info("segmentation backend is back after {} failed requests".format(self.failed))
+            self.state = CircuitBreaker.State.CLOSED
+            self.failed = 0
+            self.delay = self.backoff
+        finally:
+            self.lock.release()
+
+    def failure(self):
+        self.lock.acquire()
+        try:
+            self.failed += 1
+            if self.state == CircuitBreaker.State.HALF_OPEN \
+                or (self.state == CircuitBreaker.State.CLOSED and self.failed >= self.failures):
+                self.state = CircuitBreaker.State.OPEN
+                self.retrytime = time.monotonic() + self.delay
+                self.opened += 1
+                logging.warning("segmentation backend failed {} times in a row, retrying in {:.1f} s".format(self.failed, self.delay))
+                self.delay = min(self.delay * 2, self.maxbackoff)
+        finally:
+            self.lock.release()
+
+
+class SegmentationBackend(object):
+
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def segment(self, frame):
+        # person mask of frame, 255 is foreground. it may be smaller than frame and covers all of it
+        pass
+
+    def close(self):
+        pass
+
+
+class BodypixBackend(SegmentationBackend):
+
+    def __init__(self, url='http://localhost:9000', socketpath=None, scale=0.25, timeout=None, poolsize=4, frameformat='jpeg', maskformat='bits'):
+        self.client = BodypixClient(url, socketpath, timeout, poolsize, frameformat, maskformat)
+        self.scale = scale
+
+    def segment(self, frame):
+        return self.client.segment(frame, self.scale)
+
+    def close(self):
+        self.client.close()
+
+
+class ChromaKeyBackend(SegmentationBackend):
+
+    def __init__(self, lower=(35, 80, 60), upper=(85, 255, 255), scale=0.5, kernel=5):
+        # everything outside the hsv range of the backdrop is foreground, the default is a green screen
+        self.lower = np.array(lower, np.uint8)
+        self.upper = np.array(upper, np.uint8)
+        self.scale = scale
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel, kernel))
+
+    def segment(self, frame):
+        small = cv2.resize(frame, (0, 0), fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        mask = 255 - cv2.inRange(cv2.cvtColor(small, cv2.COLOR_BGR2HSV), self.lower, self.upper)
+        return cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel)
+
+
+class BackgroundSubtractionBackend(SegmentationBackend):
+
+    def __init__(self, history=500, threshold=16, learningrate=-1, scale=0.5, kernel=5):
+        # foreground is what differs from the learned background, works best with a fixed camera
+        # and a still scene. learningrate 0 freezes the background once it has been learned
+        self.subtractor = cv2.createBackgroundSubtractorMOG2(history, threshold, False)
+        self.learningrate = learningrate
+        self.scale = scale
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel, kernel))
+        self.lock = threading.Lock()
+
+    def segment(self, frame):
+        small = cv2.resize(frame, (0, 0), fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        # the model is updated by every frame, frames segmented at the same time are serialized
+        self.lock.acquire()
+        try:
+            mask = self.subtractor.apply(small, learningRate=self.learningrate)
+        finally:
+            self.lock.release()
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel)
+        return cv2.morphologyEx(mask, cv2.MORPH_CLOSE, self.kernel)
+
+
+class MockBackend(SegmentationBackend):
+
+    def __init__(self, latency=0.0, size=0.6):
+        # an ellipse in the center of the frame after a fixed latency, for tests and benchmarks
+        self.latency = latency
+        self.size = size
+
+    def segment(self, frame):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        h, w = frame.shape[:2]
+        mask = np.zeros((h, w), np.uint8)
+        cv2.ellipse(mask, (w // 2, h // 2), (int(w * self.size / 2), int(h * self.size / 2)), 0, 0, 360, 255, -1)
+        return mask
@@ -0,0 +1,77 @@
+import threading
+import numpy as np
+import cv2
+
+
+class GlyphAtlas(object):
+
+    def __init__(self, font, size, thickness):
+        self.font = font
+        self.size = size
+        self.thickness = thickness
+        self.glyphs = {}
+        # the height of hershey fonts does not depend on the text, the baseline does.
+        # glyphs get room for any descender and are cropped to the baseline of the text
+        (_, self.height), _ = cv2.getTextSize("A", font, size, thickness)
+        self.pad = thickness + 2
+        # descenders like the one of j reach far left of the origin
+        self.margin = self.height + thickness
+
+    def glyph(self, c):
+        g = self.glyphs.get(c)
+        if g is None:
+            # putText advances by a fractional width, measure it over many glyphs. the difference
+            # to a single glyph cancels the rounding and the thickness getTextSize adds
+            advance = (cv2.getTextSize(c * 101, self.font, self.size, self.thickness)[0][0]
+                - cv2.getTextSize(c, self.font, self.size, self.thickness)[0][0]) / 100
+            canvas = np.zeros((2 * self.height + self.pad, int(np.ceil(advance)) + 2 * self.margin), np.uint8)
+            cv2.putText(canvas, c, (self.margin, self.height - 1), self.font, self.size, 255, self.thickness)
+            # keep the drawn columns and their offset from the origin
+            columns = np.flatnonzero(canvas.any(axis=0))
+            left = columns[0] if len(columns) > 0 else self.margin
+            right = columns[-1] + 1 if len(columns) > 0 else self.margin
+            g = (advance, left - self.margin, canvas[:, left:right])
+            self.glyphs[c] = g
+        return g
+
+    def textSize(self, text):
+        return cv2.getTextSize(text, self.font, self.size, self.thickness)
+
+    def render(self, text):
+        # assemble the mask of text from the cached glyphs at the advances putText uses
+        (width, height), baseline = self.textSize(text)
+        mask = np.zeros((height + baseline, width), np.uint8)
+        x = 0.0
+        for c in text:
+            advance, offset, g = self.glyph(c)
+            x0 = int(round(x)) + offset
+            a0, a1 = max(0, -x0), min(g.shape[1], width - x0)
+            if a1 > a0:
+                # draw over the glyphs before it like putText does with antialiased edges
+                roi = mask[:, x0+a0:x0+a1]
+                cover = g[:mask.shape[0], a0:a1].astype(np.uint16)
+                roi += ((cover * (255 - roi) + 127) // 255).astype(np.uint8)
+            x += advance
+        return mask
+
+
+atlaslock = threading.Lock()
+atlases = {}
+
+def getAtlas(font, size, thickness):
+    # atlases are shared by all text layers using the same font
+    atlaslock.acquire()
+    try:
+        key = (font, size, thickness)
+        if key not in atlases:
+            atlases[key] = GlyphAtlas(font, size, thickness)
+        return atlases[key]
+    finally:
+        atlaslock.release()
+
+def colorize(mask, fgcolor, bgcolor=None):
+    frame = np.zeros(mask.shape + (3,), np.uint8)
+    if bgcolor is not None:
+        frame[:, :] = bgcolor
+    frame[mask > 0] = fgcolor
+    return frame
@@ -0,0 +1,68 @@
+import time
+import collections
+
+
+def now():
+    # all pacing uses the monotonic clock, the wall clock jumps when it is adjusted
+    return time.monotonic()
+
+
+class RateMeter(object):
+
+    def __init__(self, window=2.0):
+        self.window = window
+        self.times = collections.deque()
+
+    def tick(self, t=None):
+        t = now() if t is None else t
+        self.times.append(t)
+        while self.times[0] < t - self.window:
+            self.times.popleft()
+
+    def rate(self, t=None):
+        # frames per second within the last window
+        t = now() if t is None else t
+        while len(self.times) > 0 and self.times[0] < t - self.window:
+            self.times.popleft()
+        return len(self.times) / self.window
+
+
+class Pacer(object):
+
+    def __init__(self, period=0, maxlate=1.0):
+        self.period = period
+        self.maxlate = maxlate
+        self.deadline = None
+        self.skipped = 0
+        self.requested = None
+
+    def restart(self):
+        self.deadline = None
+
+    def wait(self, period=None):
+        # sleep until the absolute deadline of the next frame. deadlines advance by the period
+        # and not from the time of the last step, so late frames do not shift all later ones.
+        # returns the number of frames whose deadline has already passed and should be skipped
+        period = self.period if period is None else period
+        t = now()
+        if period <= 0:
+            self.requested = None
+            self.deadline = t
+            return 0
+        self.requested = 1 / period if self.requested is None else 0.9 * self.requested + 0.1 / period
+        if self.deadline is None:
+            self.deadline = t
+            return 0
+        self.deadline += period
+        missed = 0
+        if t - self.deadline > self.maxlate:
+            # stalled, e.g. paused or suspended. start over instead of catching up
+            self.deadline = t
+        elif t - self.deadline >= period:
+            missed = int((t - self.deadline) // period)
+            self.deadline += missed * period
+            self.skipped += missed
+        sleep = self.deadline - now()
+        if sleep > 0:
+            time.sleep(sleep)
+        return missed
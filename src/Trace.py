@@ -0,0 +1,43 @@
+import time
+import collections
+import numpy as np
+
+
+class FrameTrace(object):
+
+    def __init__(self, capturetime=None):
+        self.capturetime = time.monotonic() if capturetime is None else capturetime
+        self.durations = collections.OrderedDict()
+        self.ages = collections.OrderedDict()
+
+    def mark(self, stage, duration):
+        self.durations[stage] = self.durations.get(stage, 0) + duration
+
+    def age(self, name, age):
+        # how old data combined with the frame is, e.g. a mask segmented from an earlier frame
+        self.ages[name] = age
+
+
+class LatencyStats(object):
+
+    def __init__(self, size=1000):
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=size))
+
+    def add(self, trace, layertime, compositetime, writetime):
+        # split the age of an output frame into the stages it went through
+        self.samples['provider'].append(layertime - trace.capturetime)
+        for stage, duration in trace.durations.items():
+            self.samples[stage].append(duration)
+        self.samples['layer'].append(compositetime - layertime)
+        self.samples['output'].append(writetime - compositetime)
+        self.samples['total'].append(writetime - trace.capturetime)
+        for name, age in trace.ages.items():
+            self.samples[name].append(age)
+
+    def percentiles(self, q=(50, 95, 99)):
+        return collections.OrderedDict([(stage, np.percentile(np.array(samples) * 1000, q))
+            for stage, samples in self.samples.items() if len(samples) > 0])
+
+    def format(self):
+        return ", ".join(["{} {}".format(stage, "/".join(["{:.1f}".format(v) for v in values]))
+            for stage, values in self.percentiles().items()]) + " ms (p50/p95/p99)"